@@ -0,0 +1,292 @@
+"""Benchmarks for DataProcessor, the bubble figure and the Dash callbacks
+
+Generates synthetic score tables (areas x categories), times the hot paths
+and writes a JSON report that later runs can be compared against:
+
+  python benchmark.py --output before.json
+  python benchmark.py --output after.json --compare before.json
+
+With --compare the exit status is 1 if any benchmark got slower than
+--threshold times its previous median, so it can gate a deployment.
+"""
+import argparse
+import base64
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import warnings
+from importlib.util import find_spec
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_SIZES = [(40, 8), (400, 8), (4000, 8), (40000, 8), (400, 50), (4000, 50)]
+# largest table each engine is run on; the distance-based engines are O(n^2) in memory
+ENGINE_MAX_ROWS = {"smacof": 400, "classical": 4000, "pca": 40000, "landmark": 40000}
+CAMPUSES = ["IUB", "IUI", "IUB/IUI"]
+
+
+def synthetic_scores(n_areas, n_categories, seed=0):
+  """Score table shaped like data/area2category_score_campus.csv"""
+  rng = np.random.default_rng(seed)
+  scores = rng.integers(0, 11, size=(n_areas, n_categories))
+  scores[rng.random((n_areas, n_categories)) < 0.6] = 0  # sparse, like the real table
+  scores[np.arange(n_areas), rng.integers(0, n_categories, n_areas)] += 1  # no all-zero rows
+  df = pd.DataFrame(scores, columns=[f"Category {j}" for j in range(n_categories)])
+  df.insert(0, "area", [f"Research area {i}" for i in range(n_areas)])
+  df.insert(0, "area_shortname", [f"area{i}" for i in range(n_areas)])
+  df.insert(0, "campus", rng.choice(CAMPUSES, n_areas))
+  return df
+
+
+def measure(fn, repeat=5, budget=2.0, setup=None):
+  """Median/min wall time of fn(); slow functions are repeated fewer times
+
+  `setup()`, if given, runs untimed before every call.
+  """
+  times = []
+  start = time.perf_counter()
+  while len(times) < repeat:
+    if setup is not None:
+      setup()
+    t = time.perf_counter()
+    result = fn()
+    times.append(time.perf_counter() - t)
+    if time.perf_counter() - start > budget:
+      break
+  return {"median": statistics.median(times), "min": min(times), "runs": len(times)}, result
+
+
+class Runner:
+  def __init__(self, repeat):
+    self.repeat = repeat
+    self.results = {}
+
+  def bench(self, name, fn, nbytes=None, setup=None):
+    stats, result = measure(fn, self.repeat, setup=setup)
+    if nbytes is not None:
+      stats["bytes"] = nbytes(result)
+    self.results[name] = stats
+    size = f"  {stats['bytes'] / 1024:10.1f} KiB" if "bytes" in stats else ""
+    print(f"{name:<52} {stats['median'] * 1000:10.2f} ms  (min {stats['min'] * 1000:.2f}, n={stats['runs']}){size}")
+    return result
+
+
+def bench_processor(runner, csv_path, n_areas, n_categories):
+  from data_processor import DataProcessor
+  from embedding_cache import EmbeddingCache
+  from embedding_engines import get_engine
+
+  tag = f"{n_areas}x{n_categories}"
+  raw = pd.read_csv(csv_path)
+  dp = DataProcessor(csv_path, mds_seed=0, engine="pca", embedding_cache=EmbeddingCache(0))
+  runner.bench(f"load_csv[{tag}]", lambda: dp._load_data(csv_path))
+  runner.bench(f"process_loaded_df[{tag}]", lambda: dp._process_loaded_df(raw.copy()))
+  _, _, df_norm = dp._normalized()
+  runner.bench(f"normalize_scores[{tag}]", lambda: dp._normalize_scores(dp.scores))
+
+  for name, max_rows in ENGINE_MAX_ROWS.items():
+    if n_areas <= max_rows:
+      engine = get_engine(name)
+      runner.bench(f"embed.{name}[{tag}]", lambda: engine.embed(df_norm, seed=0))
+
+  records = dp.df_current.to_dict("records")
+  runner.bench(f"update_from_table_data.pca[{tag}]", lambda: dp.update_from_table_data(records))
+  edits = iter(range(10 ** 6))
+  runner.bench(f"apply_edits.pca[{tag}]", lambda: dp.apply_edits(
+    [{"row": dp.df_current.index[0], "column": dp.categories[0], "value": next(edits) % 10 + 1}]))
+  runner.bench(f"update_from_dropdown.pca[{tag}]", lambda: dp.update_from_dropdown("IUB"))
+  dp.update_from_dropdown("IUB/IUI")
+  return dp
+
+
+def bench_figure(runner, dp, n_areas, n_categories):
+  import plotly.io.json
+  import plotly.utils
+  import dash_app
+
+  tag = f"{n_areas}x{n_categories}"
+  encode = lambda obj: json.dumps(obj, cls=plotly.utils.PlotlyJSONEncoder).encode()
+  fig = runner.bench(f"bubble[{tag}]", lambda: dash_app.bubble(1200, dp.embedding_df))
+  runner.bench(f"bubble.to_json[{tag}]", lambda: encode(fig), nbytes=len)
+  patch, _ = dash_app.bubble_patch(dp.embedding_df, None)
+  runner.bench(f"bubble_patch.to_json[{tag}]", lambda: encode(patch), nbytes=len)
+
+  # payload size and encode time of plain JSON lists vs. typed arrays, with each JSON
+  # engine plotly offers (Dash encodes callback responses with to_json_plotly)
+  json_engines = ["json"] + (["orjson"] if find_spec("orjson") else [])
+  compact_figures = dash_app.compact_figures
+  try:
+    for dash_app.compact_figures, encoding in ((False, "lists"), (True, "typed")):
+      patch, _ = runner.bench(f"bubble_patch.{encoding}[{tag}]", lambda: dash_app.bubble_patch(dp.embedding_df, None))
+      for engine in json_engines:
+        runner.bench(f"bubble_patch.{encoding}.{engine}[{tag}]",
+                     lambda: plotly.io.json.to_json_plotly(patch, engine=engine).encode(), nbytes=len)
+  finally:
+    dash_app.compact_figures = compact_figures
+
+
+class DashClient:
+  """Calls Dash callbacks through the Flask test client, like the browser does"""
+
+  def __init__(self, app):
+    self.client = app.server.test_client()
+    self.dependencies = self.client.get("/_dash-dependencies").get_json()
+
+  def call(self, input_id, input_prop, value, state):
+    callback = next(d for d in self.dependencies
+                    if d["inputs"] and d["inputs"][0]["id"] == input_id and d["inputs"][0]["property"] == input_prop
+                    and not d.get("clientside_function"))
+    output = callback["output"]
+    if output.startswith(".."):
+      outputs = [dict(zip(("id", "property"), o.rsplit(".", 1))) for o in output[2:-2].split("...")]
+    else:
+      outputs = dict(zip(("id", "property"), output.rsplit(".", 1)))
+    state_values = [{**s, "value": state.get(s["id"], {}).get(s["property"])} for s in callback["state"]]
+    payload = {
+      "output": output, "outputs": outputs, "state": state_values,
+      "inputs": [{"id": input_id, "property": input_prop, "value": value}],
+      "changedPropIds": [f"{input_id}.{input_prop}"],
+    }
+    response = self.client.post("/_dash-update-component", json=payload)
+    if response.status_code not in (200, 204):
+      raise RuntimeError(f"{input_id}.{input_prop} returned {response.status_code}")
+    return len(json.dumps(payload)), response.data
+
+
+def bench_callbacks(runner, csv_path, n_areas, n_categories):
+  import dash_app
+  from embedding_cache import default_cache
+
+  tag = f"{n_areas}x{n_categories}"
+  client = DashClient(dash_app.app)
+  session_id = str(uuid.uuid4())
+  content = "data:text/csv;base64," + base64.b64encode(Path(csv_path).read_bytes()).decode()
+  with dash_app.sessions.session(session_id) as data_processor:
+    data_processor.update_from_upload(pd.read_csv(csv_path))
+    records = dash_app.current_records(data_processor)
+    legend = dash_app.figure_legend(data_processor.embedding_df)
+  # table edits are diffed against data_previous: every call sends one changed score cell
+  score_column = data_processor.score_columns[0]
+  previous = [dict(record) for record in records]
+  state = {
+    "session-id": {"data": session_id},
+    "figure-legend": {"data": legend},
+    "editable-table": {"data": records, "data_previous": previous},
+    "upload-table": {"filename": "scores.csv"},
+  }
+
+  def table_edits(values):
+    for i, value in enumerate(values):
+      records[0][score_column] = value
+      previous[0][score_column] = value + 1
+      yield i
+
+  def bench_callback(name, input_id, input_prop, cold_values, warm_values):
+    # cold: the embedding cache is cleared before every call, so MDS runs each time;
+    # warm: inputs repeat, so the embeddings are cache hits after the first round
+    for mode, values, setup in (("cold", cold_values, default_cache.clear), ("warm", warm_values, None)):
+      label = f"callback.{name}.{mode}[{tag}]"
+      request_bytes, _ = runner.bench(label, lambda: client.call(input_id, input_prop, next(values), state),
+                                      nbytes=lambda result: len(result[1]), setup=setup)
+      runner.results[label]["request_bytes"] = request_bytes
+
+  campuses = ["IUB", "IUI", "IUB/IUI"]
+  bench_callback("campus", "canpus-dropdown", "value", itertools.cycle(campuses), itertools.cycle(campuses))
+  bench_callback("seed_input", "mds-seed-input", "value", (str(seed) for seed in itertools.count(1)),
+                 itertools.cycle(["1", "2"]))
+  bench_callback("table_edit", "editable-table", "data_timestamp",
+                 table_edits(i % 10 + 1 for i in itertools.count()), table_edits(itertools.repeat(5)))
+  bench_callback("upload", "upload-table", "contents", itertools.repeat(content), itertools.repeat(content))
+  dash_app.sessions.discard(session_id)
+
+
+def bench_startup(runner):
+  """Cold import of dash_app in a fresh interpreter, like a Render cold start or worker spawn
+
+  dash_app logs its own breakdown (imports, data, initial view, ...) to stderr.
+  """
+  command = [sys.executable, "-W", "ignore", "-c", "import dash_app"]
+  result = runner.bench("startup.import_dash_app", lambda: subprocess.run(command, check=True, capture_output=True, text=True))
+  print("  " + next(line for line in reversed(result.stderr.splitlines()) if "startup: " in line))
+
+
+def compare(results, baseline, threshold, min_delta):
+  """Print median ratios against a previous report; returns the names that regressed
+  
+  A benchmark regresses if its median grew by more than `threshold` times and
+  by more than `min_delta` seconds, so sub-millisecond noise is not flagged.
+  """
+  regressions = []
+  print(f"\n{'benchmark':<52} {'before':>10} {'after':>10} {'ratio':>7}")
+  for name, stats in results.items():
+    if name not in baseline or not baseline[name]["median"]:
+      continue
+    before, after = baseline[name]["median"], stats["median"]
+    ratio = after / before
+    flag = "  REGRESSION" if ratio > threshold and after - before > min_delta else ""
+    if flag:
+      regressions.append(name)
+    print(f"{name:<52} {before * 1000:8.2f}ms {after * 1000:8.2f}ms {ratio:6.2f}x{flag}")
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--sizes", nargs="+", default=[f"{n}x{k}" for n, k in DEFAULT_SIZES],
+                      help="synthetic table sizes as AREASxCATEGORIES")
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--max-callback-rows", type=int, default=4000,
+                      help="largest table driven through the Dash callbacks")
+  parser.add_argument("--output", type=Path, help="write the JSON report here")
+  parser.add_argument("--compare", type=Path, help="previous JSON report to compare against")
+  parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio counted as a regression")
+  parser.add_argument("--min-delta", type=float, default=0.005, help="ignore slowdowns smaller than this (seconds)")
+  args = parser.parse_args()
+
+  runner = Runner(args.repeat)
+  print("# startup")
+  bench_startup(runner)  # before the environment below, so the app starts as deployed
+
+  warnings.filterwarnings("ignore", category=FutureWarning)
+  # callbacks run on synthetic tables too large for SMACOF, and inline so timings are per request
+  os.environ.setdefault("EMBEDDING_ENGINE", "pca")
+  os.environ.setdefault("MDS_EXECUTOR", "thread")
+
+  with tempfile.TemporaryDirectory() as tmp:
+    for size in args.sizes:
+      n_areas, n_categories = map(int, size.split("x"))
+      csv_path = Path(tmp).joinpath(f"scores_{size}.csv")
+      synthetic_scores(n_areas, n_categories).to_csv(csv_path, index=False)
+      print(f"\n# {n_areas} areas x {n_categories} categories")
+      dp = bench_processor(runner, csv_path, n_areas, n_categories)
+      bench_figure(runner, dp, n_areas, n_categories)
+      if n_areas <= args.max_callback_rows:
+        bench_callbacks(runner, csv_path, n_areas, n_categories)
+
+  report = {
+    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "python": sys.version.split()[0],
+    "platform": platform.platform(),
+    "results": runner.results,
+  }
+  if args.output:
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"\nwrote {args.output}")
+  if args.compare:
+    regressions = compare(runner.results, json.loads(args.compare.read_text())["results"], args.threshold, args.min_delta)
+    if regressions:
+      print(f"\n{len(regressions)} regression(s) over {args.threshold}x")
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
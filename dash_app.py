@@ -1,77 +1,317 @@
+import time
+startup_begin = time.perf_counter()  # import and startup timings are logged once the app is built
+
 from dash import Dash, dcc, html, Input, Output, Patch, State, dash_table, no_update
-import io, os
+from dash.exceptions import PreventUpdate
+import io, logging, os
 import base64
+import itertools
+import uuid
+from contextlib import contextmanager
+from importlib.util import find_spec
 import plotly.graph_objects as go
+import plotly.io as pio
 
+import numpy as np
 import pandas as pd
-import seaborn as sns
 from pathlib import Path
-from collections import defaultdict 
+from flask import Response, abort, request, send_file
+
+from data_processor import EXPORT_FORMATS, DataProcessor
+from embedding_cache import default_cache
+from embedding_jobs import JobSuperseded, jobs
+from ingest import MAX_UPLOAD_BYTES, EditError, UploadError, format_error, read_upload
+from metrics import metrics
+from session_store import SessionStore
+
+startup_timings = {"imports": time.perf_counter() - startup_begin}  # seconds per startup stage
+
+# diagnostics go to stderr, stdout may carry the METRICS_LOG=- JSON lines
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+logger = logging.getLogger("dash_app")
+
+
+@contextmanager
+def startup_stage(name):
+  start = time.perf_counter()
+  yield
+  startup_timings[name] = time.perf_counter() - start
 
-from data_processor import DataProcessor
 
 # bubble plot data
 data_dir = Path("./data")
-data_processor = DataProcessor(data_dir.joinpath("area2category_score_campus.csv"),  mds_seed=2971) # mds_seed need to be int
-df = data_processor.df_original
-embedding_df = data_processor.embedding_df
+with startup_stage("data"):
+  csv_path = data_dir.joinpath("area2category_score_campus.csv")
+  data_processor = DataProcessor(csv_path,  mds_seed=2971, # mds_seed need to be int
+                                 precomputed_path=data_dir.joinpath("embeddings.npz")) # built by precompute.py
 categories = data_processor.categories
 editable_table_exclude_cols = data_processor.editable_table_exclude_cols
 bubble_size = data_processor.bubble_size
 font_size = data_processor.font_size
+bubble_sizeref = 2.*bubble_size/(100.**2)  # divided by the window scale factor on resize, in the browser
 
 # extra info: area pis & links
-area2pi2url = pd.read_csv(data_dir.joinpath("area2pi2url.csv"))
-area2pis_dict = defaultdict(list)
-for area in area2pi2url['area'].unique():
-  area2pis_dict[area] = area2pi2url[area2pi2url['area'] == area]['pi'].tolist()
-pi2url_df = area2pi2url[['pi', 'url']].drop_duplicates()
-pi2url_dict = pi2url_df.set_index('pi')['url'].to_dict()
+with startup_stage("pi_index"):
+  area2pi2url = pd.read_csv(data_dir.joinpath("area2pi2url.csv"))
+  area2pis_dict = {area: sorted(set(pis)) for area, pis in area2pi2url.groupby('area', sort=False)['pi']}
+  pi2url_dict = area2pi2url[['pi', 'url']].drop_duplicates().set_index('pi')['url'].to_dict()
 
 
-def bubble(width=1200, data=None):
-  # colors = ["blue", "green", "red", "orange", "purple", "gray", "brown", ]
-  colors = sns.color_palette("tab10", n_colors=10).as_hex()
-  cat2color_dict = dict(zip(embedding_df["category"].unique(), colors))
-  categories = sorted(embedding_df["category"].unique())
-  embedding_df["category_color"] = embedding_df["category"].map(cat2color_dict)
-  hover_text = embedding_df["area"]
+def sidebar_children(area):
+  """Sidebar content for a clicked area: its name and links to its PIs' profiles"""
+  info_children = [
+    html.P(area, style={'margin-bottom': '10px'}),
+  ]
+  for pi in area2pis_dict.get(area, []):
+    if pi in pi2url_dict:
+      info_children.append(
+        html.A(pi, href=pi2url_dict[pi], target="_blank",
+               style={'display': 'block', 'margin-bottom': '5px'})
+      )
+    else:
+      info_children.append(html.Div(pi, style={'margin-bottom': '5px'}))
+  return info_children
 
-  fig = go.Figure(
+
+# rendered once per area and shipped to the browser in the sidebar-content store,
+# so bubble clicks are handled by a clientside callback
+with startup_stage("sidebar"):
+  sidebar_content = {area: sidebar_children(area) for area in area2pis_dict}
+
+# per-session state: every browser page load gets its own copy of data_processor.
+# set SESSION_STORE_DIR to a shared directory when running several worker processes.
+# Sessions are then pickled without their distance matrix and export cache; each worker
+# keeps its last SESSION_CACHE_SIZE sessions in memory with those caches, and rebuilds
+# them only for a session another worker saved since
+sessions = SessionStore(
+  data_processor.copy,
+  ttl=int(os.environ.get('SESSION_TTL', 3600)),
+  max_sessions=int(os.environ.get('SESSION_MAX_COUNT', 256)),
+  max_bytes=int(os.environ['SESSION_MAX_BYTES']) if 'SESSION_MAX_BYTES' in os.environ else None,
+  directory=os.environ.get('SESSION_STORE_DIR'),
+  cache_size=int(os.environ.get('SESSION_CACHE_SIZE', 16)),
+)
+
+# with EMBEDDING_BANK_SIZE > 0 the "change MDS seed" button cycles, in the browser,
+# through that many layouts precomputed whenever the data or campus filter changes
+embedding_bank_size = int(os.environ.get('EMBEDDING_BANK_SIZE', 0))
+# otherwise the button embeds MDS_SEED_CANDIDATES random seeds in parallel and shows
+# the best one by MDS_SEED_CRITERION ('stress' or 'separation')
+mds_seed_candidates = int(os.environ.get('MDS_SEED_CANDIDATES', 1))
+mds_seed_criterion = os.environ.get('MDS_SEED_CRITERION', 'stress')
+
+# above LARGE_DATA_THRESHOLD bubbles the plot switches to WebGL, merges bubbles sharing
+# a cell of a CLUSTER_GRID x CLUSTER_GRID raster, and only shows labels once zoomed in
+# to at most LABEL_LIMIT bubbles (hover text is always available)
+large_data_threshold = int(os.environ.get('LARGE_DATA_THRESHOLD', 1000))
+cluster_grid = int(os.environ.get('CLUSTER_GRID', 150))
+label_limit = int(os.environ.get('LABEL_LIMIT', 200))
+
+# figures carry numeric trace data as base64 typed arrays and bubble colors as category
+# codes into a discrete colorscale; COMPACT_FIGURES=0 sends plain JSON lists and hex colors
+compact_figures = os.environ.get('COMPACT_FIGURES', '1') != '0'
+# Dash encodes responses with plotly's JSON encoder. JSON_ENGINE=orjson (or "auto") switches
+# to orjson when it is installed; on these payloads, mostly label strings, it measured slower
+# than the json module (see the bubble_patch.* rows of benchmark.py)
+pio.json.config.default_engine = os.environ.get('JSON_ENGINE', 'json')
+
+# with TABLE_PAGE_SIZE > 0 the score table is paged, sorted and filtered on the server;
+# the browser only holds the visible page and edits are sent back as cell deltas
+table_page_size = int(os.environ.get('TABLE_PAGE_SIZE', 0))
+
+metrics.gauge("embedding_cache_hits", "Embedding cache hits since start.", lambda: default_cache.hits)
+metrics.gauge("embedding_cache_misses", "Embedding cache misses since start.", lambda: default_cache.misses)
+metrics.gauge("embedding_cache_hit_ratio", "Embedding cache hit rate.", lambda: default_cache.stats()["hit_rate"])
+metrics.gauge("embedding_cache_entries", "Embeddings held in the cache.", lambda: len(default_cache))
+metrics.gauge("sessions_active", "Sessions held by the session store.", lambda: len(sessions))
+metrics.gauge("sessions_bytes", "Approximate memory of in-process sessions, or size of the session files.", lambda: sessions.stats()["nbytes"])
+
+
+@contextmanager
+def session_job(session_id, kind, supersede=True):
+  """Session state whose MDS runs go through the background job manager
+  
+  A newer call for the same session and `kind` supersedes this one: its queued
+  MDS job is cancelled and the callback returns without updating the page.
+  Calls whose changes a newer call does not repeat, like table edits sent as
+  cell deltas, pass `supersede=False` and always run to the end.
+  """
+  token = jobs.claim((session_id, kind) if supersede else (session_id, kind, uuid.uuid4().hex))
+  try:
+    with sessions.session(session_id) as data_processor:
+      jobs.check(token)
+      data_processor.runner = jobs.runner(token)
+      try:
+        yield data_processor
+      finally:
+        data_processor.runner = None
+  except JobSuperseded:
+    raise PreventUpdate
+  finally:
+    jobs.release(token)
+
+
+# matplotlib's tab10 palette, as seaborn.color_palette("tab10").as_hex() returns it
+TAB10 = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd",
+         "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf"]
+
+
+NEUTRAL_COLOR = "#bdbdbd"  # bubbles whose category has no color
+
+
+def category_colors(embedding_df):
+  """Map categories to tab10 colors in order of appearance, repeating the palette past 10"""
+  return dict(zip(embedding_df["category"].unique(), itertools.cycle(TAB10)))
+
+
+def download_href(table, session_id=None, fmt="csv"):
+  """URL of the /download route for the original or a session's current table"""
+  query = f"?format={fmt}" + (f"&session={session_id}" if session_id else "")
+  return app.get_relative_path(f"/download/{table}") + query
+
+
+def current_records(data_processor):
+  """Every row of the current table, with its row position as `id` for table_edits"""
+  df = data_processor.df_current
+  return df.assign(id=df.index).to_dict('records')
+
+
+def table_records(data_processor):
+  """Table data for a campus/upload update; a paged table refetches its page on data-version"""
+  if table_page_size:
+    return no_update
+  return current_records(data_processor)
+
+
+def table_edits(data, data_previous):
+  """Cell deltas between two versions of the visible table page"""
+  previous = {row['id']: row for row in data_previous or []}
+  return [{'row': row['id'], 'column': column, 'value': value}
+          for row in data or [] if row.get('id') in previous
+          for column, value in row.items() if column != 'id' and previous[row['id']].get(column) != value]
+
+
+def numeric_array(values, dtype=np.float32):
+  """Numeric trace data as a plotly.js typed array spec {dtype, bdata}, or a plain array with COMPACT_FIGURES=0"""
+  values = np.asarray(values, dtype=np.dtype(dtype).newbyteorder('<'))
+  if not compact_figures:
+    return values
+  return {"dtype": values.dtype.str[1:], "bdata": base64.b64encode(values.tobytes()).decode('ascii')}
+
+
+def marker_colors(categories, cat2color_dict):
+  """Marker color properties: category codes into a discrete colorscale, or one hex color per point"""
+  if not compact_figures:
+    return dict(color=categories.astype(object).map(cat2color_dict).fillna(NEUTRAL_COLOR).to_numpy())
+  # code 0 is the neutral color, for categories missing from cat2color_dict (Categorical code -1)
+  colors = [NEUTRAL_COLOR] + list(cat2color_dict.values())
+  codes = pd.Categorical(categories, categories=list(cat2color_dict)).codes.astype(np.int64) + 1
+  # code i sits exactly on the i-th stop of the scale
+  stops = np.linspace(0, 1, len(colors))
+  return dict(
+    color=numeric_array(codes, np.uint8 if len(colors) <= 256 else np.uint16),
+    colorscale=[[float(stop), color] for stop, color in zip(stops, colors)],
+    cmin=0, cmax=len(colors) - 1, showscale=False,
+  )
+
+
+def legend_traces(cat2color_dict):
+  """Invisible traces for legend entries, one per category"""
+  return [
     go.Scatter(
-      x=embedding_df["x"],
-      y=embedding_df["y"],
+        x=[None], y=[None],  # No actual data points
+        mode="markers",
+        marker=dict(color=cat2color_dict[cat], 
+                    opacity=0.1,
+                    size=10),
+        name=cat,
+        showlegend=True,
+    )
+    for cat in sorted(cat2color_dict)
+  ]
+
+
+def cluster_points(embedding_df, x_range=(0, 1), y_range=(0, 1), grid=None):
+  """Merge the points inside the visible range that share a cell of a grid x grid raster
+  
+  Each cluster sits at the mean of its points and is labelled after its first
+  point; `count` holds the number of areas it stands for.
+  """
+  grid = cluster_grid if grid is None else grid
+  (x0, x1), (y0, y1) = x_range, y_range
+  visible = embedding_df[embedding_df["x"].between(x0, x1) & embedding_df["y"].between(y0, y1)]
+  cx = ((visible["x"] - x0) / ((x1 - x0) or 1) * grid).astype(int).clip(0, grid - 1)
+  cy = ((visible["y"] - y0) / ((y1 - y0) or 1) * grid).astype(int).clip(0, grid - 1)
+  clusters = visible.groupby((cx * grid + cy).to_numpy(), sort=False).agg(
+    x=("x", "mean"), y=("y", "mean"), count=("x", "size"),
+    area=("area", "first"), area_campus=("area_campus", "first"), category=("category", "first"),
+  )
+  return clusters.reset_index(drop=True)
+
+
+def trace_data(embedding_df, cat2color_dict, x_range=None, y_range=None):
+  """Properties of the main bubble trace, clustered and in WebGL for large embeddings"""
+  if len(embedding_df) <= large_data_threshold:
+    return dict(
+      type="scatter",
       mode="markers+text",
+      x=numeric_array(embedding_df["x"]),
+      y=numeric_array(embedding_df["y"]),
+      text=embedding_df["area_campus"].to_numpy(),
+      hovertext=embedding_df["area"].to_numpy(),
+      customdata=embedding_df[["area", "category"]].values,
+      # every bubble has the same size
+      marker=dict(size=bubble_size, **marker_colors(embedding_df["category"], cat2color_dict)),
+    )
+  clusters = cluster_points(embedding_df, x_range or (0, 1), y_range or (0, 1))
+  merged = clusters["count"] > 1
+  area = clusters["area"].astype(str)
+  hover_text = area.where(~merged, clusters["count"].astype(str) + " areas, e.g. " + area)
+  show_labels = len(clusters) <= label_limit
+  return dict(
+    type="scattergl",
+    mode="markers+text" if show_labels else "markers",
+    x=numeric_array(clusters["x"]),
+    y=numeric_array(clusters["y"]),
+    text=clusters["area_campus"].to_numpy() if show_labels else None,
+    hovertext=hover_text.to_numpy(),
+    customdata=clusters[["area", "category"]].values,
+    marker=dict(size=numeric_array(bubble_size * np.minimum(np.sqrt(clusters["count"].to_numpy()), 4)),
+                **marker_colors(clusters["category"], cat2color_dict)),
+  )
+
+
+def bubble(width=1200, data=None):
+  embedding_df = data_processor.embedding_df if data is None else data
+  cat2color_dict = category_colors(embedding_df)
+  trace = trace_data(embedding_df, cat2color_dict)
+  scatter = go.Scattergl if trace["type"] == "scattergl" else go.Scatter
+
+  fig = go.Figure(
+    scatter(
+      x=trace["x"],
+      y=trace["y"],
+      mode=trace["mode"],
       marker=dict(
-          size=embedding_df["size"],
           sizemode='area',
-          sizeref=2.*max(embedding_df["size"])/(100.**2),  # scale size_max=60
+          sizeref=bubble_sizeref,  # scale size_max=60
           opacity=0.1,
-          color=embedding_df["category_color"],
+          **trace["marker"],
       ),
-      text=embedding_df["area_campus"],
-      hovertext=hover_text,
+      text=trace["text"],
+      hovertext=trace["hovertext"],
       hoverinfo="text",  # Only show hovertext
       showlegend=False,
-      customdata=embedding_df[["area", "category"]].values,
+      customdata=trace["customdata"],
     )
   ) #Figure
 
   # Add invisible traces for legend entries
-  for cat in categories:
-      fig.add_trace(
-          go.Scatter(
-              x=[None], y=[None],  # No actual data points
-              mode="markers",
-              marker=dict(color=cat2color_dict[cat], 
-                          opacity=0.1,
-                          size=10),
-              name=cat,
-              showlegend=True,
-          )
-      )
+  fig.add_traces(legend_traces(cat2color_dict))
   fig.update_layout(
       autosize=True,
+      # constant, so Plotly.react keeps the user's zoom and pan across server patches
+      uirevision="bubble",
       # width=800, height=800, ## comment out for auto height
       # width=None, height=None, ## comment out for auto height
       plot_bgcolor='rgba(0,0,0,0)',
@@ -102,299 +342,410 @@ def bubble(width=1200, data=None):
   return fig
 
 
-app = Dash(__name__, external_stylesheets=['/assets/style.css'])
+def figure_legend(embedding_df):
+  """[category, color] pairs drawn as legend traces, kept in the figure-legend store"""
+  return sorted(category_colors(embedding_df).items())
+
+
+def patch_trace(patched, trace):
+  """Assign trace_data() output to the main trace of a figure Patch"""
+  for key in ("type", "mode", "x", "y", "text", "hovertext", "customdata"):
+    patched['data'][0][key] = trace[key]
+  for key, value in trace["marker"].items():
+    patched['data'][0]['marker'][key] = value
+  return patched
+
+
+def bubble_patch(embedding_df, legend, coords_only=False):
+  """Patch the main trace of the bubble figure with a new embedding
+  
+  Legend traces are replaced only when the categories or their colors differ
+  from `legend`, the figure-legend store of the figure currently shown.
+  Marker sizeref and text size are left alone, they follow the window width
+  in the browser. With `coords_only` (same rows, new layout, e.g. another MDS
+  seed) only x and y are sent, unless the plot is clustered.
+  """
+  if coords_only and len(embedding_df) <= large_data_threshold:
+    patched = Patch()
+    patched['data'][0]['x'] = numeric_array(embedding_df["x"])
+    patched['data'][0]['y'] = numeric_array(embedding_df["y"])
+    return patched, legend
+  cat2color_dict = category_colors(embedding_df)
+  patched = patch_trace(Patch(), trace_data(embedding_df, cat2color_dict))
+  
+  new_legend = sorted(cat2color_dict.items())
+  if legend is None or [tuple(item) for item in legend] != new_legend:
+    for _ in range(len(legend or [])):
+      del patched['data'][1]
+    patched['data'].extend(legend_traces(cat2color_dict))
+  return patched, new_legend
+
+
+# responses are gzip/brotli compressed when flask-compress is installed (COMPRESS=0 disables it)
+compress = os.environ.get('COMPRESS', '1') != '0' and find_spec('flask_compress') is not None
+with startup_stage("app"):
+  app = Dash(__name__, external_stylesheets=['/assets/style.css'], compress=compress)
+server = app.server  # WSGI callable, see wsgi.py
 
-app.layout = html.Div(
-  [
-    dcc.Store(id="dimensions"),
-    dcc.Store(id="table-visible", data=False),  # table visibility state
-    html.Div(id='dummy'),
+# every page load starts from the same (precomputed) embedding of the startup data:
+# build its figure, legend and table once instead of per layout request
+with startup_stage("initial_view"):
+  initial_figure = bubble(1200).to_plotly_json()
+  initial_legend = figure_legend(data_processor.embedding_df)
+  if table_page_size:
+    page, page_count = data_processor.table_page(0, table_page_size)
+    initial_table = dict(data=page, page_current=0, page_size=table_page_size, page_count=page_count,
+                         page_action="custom", sort_action="custom", filter_action="custom", sort_by=[])
+  else:
+    initial_table = dict(data=current_records(data_processor), sort_action="native")
+  initial_columns = [{"name": i, "id": i} for i in data_processor.df_current.columns if i not in editable_table_exclude_cols]
+
+def serve_layout():
+  session_id = str(uuid.uuid4())
+  return html.Div(
+    [
+      dcc.Store(id="session-id", data=session_id),
+      dcc.Store(id="bubble-scale", data={"width": 1200, "sizeref": bubble_sizeref, "font_size": font_size}),
+      dcc.Store(id="figure-legend", data=initial_legend),
+      dcc.Store(id="data-version", data=data_processor.data_version),
+      dcc.Store(id="sidebar-content", data=sidebar_content),  # {area: sidebar children}
+      dcc.Store(id="embedding-bank"),  # {"seeds", "shape", "data": base64 float32 layouts}
+      dcc.Store(id="bank-index", data=0),
+      dcc.Store(id="seed-request"),  # button clicks the embedding bank cannot serve
+      dcc.Store(id="zoom-request"),  # axis changes of a clustered plot, re-clustered on the server
+      dcc.Store(id="table-visible", data=False),  # table visibility state
+      html.Div(id='dummy'),
     
-    # Main container with flexbox layout
-    html.Div([
-      # Plot area (left side)
+      # Main container with flexbox layout
       html.Div([
-        dcc.Graph(
-          id="bubble",
-          figure=bubble(1200),
-          style={
-            'width': '100%',
-            'height': '100%',
-          },
-          config={
-            'displayModeBar': False  # hide plotly toolbar
-          },
-          responsive=True,
-        ),
-        # Dropdown positioned at top right
+        # Plot area (left side)
         html.Div([
-          dcc.Dropdown(
-            id='canpus-dropdown',
-            options=[{"label": "IUB / IUI", "value":'IUB/IUI'}, 
-                     {"label": "IUB", "value":'IUB'}, 
-                     {"label": "IUI", "value":'IUI'}],
-            value='IUB/IUI',  # default 
-            clearable=False,
-            style={
-              'width': '94px',
-              'font-size': '12px'
-            }
+          dcc.Loading(  # shown while a recompute callback waits for its MDS job
+            dcc.Graph(
+              id="bubble",
+              figure=initial_figure,
+              style={
+                'width': '100%',
+                'height': '100%',
+              },
+              config={
+                'displayModeBar': False  # hide plotly toolbar
+              },
+              responsive=True,
+            ),
+            type="circle",
+            delay_show=300,
+            target_components={"bubble": "figure"},
+            overlay_style={"visibility": "visible", "opacity": 0.5},
+            parent_style={'width': '100%', 'height': '100%'},
           ),
-        ], 
-        title='select campus',
-        style={
-          'position': 'absolute',
-          'top': '10px',
-          'right': '10px',
-          'z-index': '1000'
-        }),
-        html.Div([
-          # mds input box
+          # Dropdown positioned at top right
           html.Div([
-            dcc.Input(
-              id='mds-seed-input',
-              placeholder='',
-              value="",
-              debounce=True,
-              autoComplete='off',
-              autoFocus=False, spellCheck=False,
+            dcc.Dropdown(
+              id='canpus-dropdown',
+              options=[{"label": "IUB / IUI", "value":'IUB/IUI'}, 
+                       {"label": "IUB", "value":'IUB'}, 
+                       {"label": "IUI", "value":'IUI'}],
+              value='IUB/IUI',  # default 
+              clearable=False,
               style={
-                'width': '50px',
-                'padding': '8px 12px',
-                'background-color': 'rgba(255, 255, 255, 0.9)',
-                'border': '1px solid #ccc',
-                # 'border-radius': '4px',
+                'width': '94px',
                 'font-size': '12px'
               }
             ),
           ], 
-          title="enter an integer as MDS seed",
+          title='select campus',
           style={
-            # 'position': 'absolute',
-            # 'bottom': '10px',
-            # 'left': '10px',
-            'z-index': '1000',
-            'margin-right': '5px'
+            'position': 'absolute',
+            'top': '10px',
+            'right': '10px',
+            'z-index': '1000'
           }),
-          # Button positioned in lower left corner
-          html.Button(
-            "change MDS seed",
-            id="mds-seed-button",
-            title="change random seed for MDS embedding",
+          html.Div([
+            # mds input box
+            html.Div([
+              dcc.Input(
+                id='mds-seed-input',
+                placeholder='',
+                value="",
+                debounce=True,
+                autoComplete='off',
+                autoFocus=False, spellCheck=False,
+                style={
+                  'width': '50px',
+                  'padding': '8px 12px',
+                  'background-color': 'rgba(255, 255, 255, 0.9)',
+                  'border': '1px solid #ccc',
+                  # 'border-radius': '4px',
+                  'font-size': '12px'
+                }
+              ),
+            ], 
+            title="enter an integer as MDS seed",
             style={
               # 'position': 'absolute',
               # 'bottom': '10px',
-              # 'left': '80px',
-              # 'z-index': '1000',
-              'padding': '8px 12px',
-              'background-color': 'rgba(255, 255, 255, 0.9)',
-              'border': '1px solid #ccc',
-              'border-radius': '4px',
-              'cursor': 'pointer',
-              'font-size': '12px',
+              # 'left': '10px',
+              'z-index': '1000',
               'margin-right': '5px'
-            }
-          ),
-          # Error message display
-          html.Div(id="input-error-message", style={'display': 'none'})
-        ], className="mds-control", style={
-          'position': 'absolute',
-          'bottom': '10px',
-          'left': '0px',
-          'z-index': '1000',
-          'display': 'flex',  # Use flexbox for horizontal layout
-          'align-items': 'center',  # Vertical alignment
-          }),
-      ], className="plot-area", style={'position': 'relative'}),
+            }),
+            # Button positioned in lower left corner
+            html.Button(
+              "change MDS seed",
+              id="mds-seed-button",
+              title="change random seed for MDS embedding",
+              style={
+                # 'position': 'absolute',
+                # 'bottom': '10px',
+                # 'left': '80px',
+                # 'z-index': '1000',
+                'padding': '8px 12px',
+                'background-color': 'rgba(255, 255, 255, 0.9)',
+                'border': '1px solid #ccc',
+                'border-radius': '4px',
+                'cursor': 'pointer',
+                'font-size': '12px',
+                'margin-right': '5px'
+              }
+            ),
+            # Error message display
+            html.Div(id="input-error-message", style={'display': 'none'})
+          ], className="mds-control", style={
+            'position': 'absolute',
+            'bottom': '10px',
+            'left': '0px',
+            'z-index': '1000',
+            'display': 'flex',  # Use flexbox for horizontal layout
+            'align-items': 'center',  # Vertical alignment
+            }),
+        ], className="plot-area", style={'position': 'relative'}),
       
-      # Sidebar (right side)
-      html.Div([
-        html.Div(id="click-info"),
-      ], className="sidebar"),
-    ], className="main-row"),
+        # Sidebar (right side)
+        html.Div([
+          html.Div(id="click-info"),
+        ], className="sidebar"),
+      ], className="main-row"),
     
-    # Editable table
-    html.Div([
-      html.Button("edit score table", id="toggle-table-btn", n_clicks=0,),
+      # Editable table
+      html.Div([
+        html.Button("edit score table", id="toggle-table-btn", n_clicks=0,),
 
-      html.Button("download original table", id="btn-download-orig",),
-      dcc.Download(id="download-curr-table",),
+        # plain links to the streamed /download routes, see download_href
+        html.A(html.Button("download original table", id="btn-download-orig",),
+               id="link-download-orig", href=download_href("original"), download=""),
       
-      html.Button("download current table", id="btn-download-curr",),
-      dcc.Download(id="download-orig-table"),
+        html.A(html.Button("download current table", id="btn-download-curr",),
+               id="link-download-curr", href=download_href("current", session_id), download=""),
+        dcc.RadioItems(id="download-format", options=list(EXPORT_FORMATS), value="csv", inline=True),
       
-      dcc.Upload(
-        html.Button("upload score table", id="btn-upload",),
-        id="upload-table"
-      ),
-    ], className="button-row", style={'display': 'flex', 'flex-wrap': 'wrap'}),
-    html.Div([
-      html.Div([dash_table.DataTable( # make score table editable
-          id='editable-table',
-          data=data_processor.df_current.to_dict('records'),
-          columns=[{"name": i, "id": i} for i in data_processor.df_current.columns if i not in editable_table_exclude_cols],
-          editable=True,
-          # page_size=10,
-          fixed_rows={'headers': True},
-          fixed_columns={'headers': True, 'data': 2},
-          sort_action="native",
-          sort_mode="multi",
-          style_table={
-            'height': '350px',
-            'overflowX': 'auto', 
-            'overflowY': 'auto',
-            'minWidth': '80%',
-            'maxWidth': '100%'
-          },
-          style_header={'textAlign': 'center'},
-          style_cell_conditional=[{'if': {'column_id': c},
-               'textAlign': 'center',
-               'minWidth': '100px', 'width': '100px', 'maxWidth': '100px',
-               } for c in data_processor.categories
-          ] + [
-            {'if': {'column_id': 'campus'},
-            'width': '50px', 'textAlign': 'right'},
-            {'if': {'column_id': 'area_shortname'},
-            'width': '140px', 'textAlign': 'left'},
-          ],
+        dcc.Upload(
+          html.Button("upload score table", id="btn-upload",),
+          id="upload-table",
+          max_size=MAX_UPLOAD_BYTES,
         ),
-      ], className="editable-table-container"),
+        dcc.Checklist(id="upload-append", options=[{"label": "append rows", "value": "append"}], value=[], inline=True),
+        html.Div(id="upload-error-message", style={'display': 'none'}),
+        html.Div(id="table-error-message", style={'display': 'none'}),
+      ], className="button-row", style={'display': 'flex', 'flex-wrap': 'wrap'}),
       html.Div([
-        html.Div(id="click-info-table"),  # Secondary click info for table view
-      ], className="dummy_sidebar"),
-    ], className="table-row", id="table-container", style={'display': 'none'}),
-  ], style={
-    'width': '100vw',
-    'height': '100vh',
-    'marginTop': '0px',    
-    'marginLeft': '15px',   
-    'boxSizing': 'border-box'  # Include margin in size calculation
-  },
+        html.Div([dash_table.DataTable( # make score table editable
+            id='editable-table',
+            columns=initial_columns,
+            editable=True,
+            fixed_rows={'headers': True},
+            fixed_columns={'headers': True, 'data': 2},
+            sort_mode="multi",
+            **initial_table,
+            style_table={
+              'height': '350px',
+              'overflowX': 'auto', 
+              'overflowY': 'auto',
+              'minWidth': '80%',
+              'maxWidth': '100%'
+            },
+            style_header={'textAlign': 'center'},
+            style_cell_conditional=[{'if': {'column_id': c},
+                 'textAlign': 'center',
+                 'minWidth': '100px', 'width': '100px', 'maxWidth': '100px',
+                 } for c in data_processor.categories
+            ] + [
+              {'if': {'column_id': 'campus'},
+              'width': '50px', 'textAlign': 'right'},
+              {'if': {'column_id': 'area_shortname'},
+              'width': '140px', 'textAlign': 'left'},
+            ],
+          ),
+        ], className="editable-table-container"),
+        html.Div([
+          html.Div(id="click-info-table"),  # Secondary click info for table view
+        ], className="dummy_sidebar"),
+      ], className="table-row", id="table-container", style={'display': 'none'}),
+    ], style={
+      'width': '100vw',
+      'height': '100vh',
+      'marginTop': '0px',    
+      'marginLeft': '15px',   
+      'boxSizing': 'border-box'  # Include margin in size calculation
+    },
   
-)
+  )
+
+
+app.layout = serve_layout
 
 # Campus dropdown handler
 @app.callback(
   [Output("bubble", "figure", allow_duplicate=True),
    Output('editable-table', 'data', allow_duplicate=True),
-   Output('editable-table', 'columns', allow_duplicate=True)],
+   Output('editable-table', 'columns', allow_duplicate=True),
+   Output('figure-legend', 'data', allow_duplicate=True),
+   Output('data-version', 'data', allow_duplicate=True)],
   Input('canpus-dropdown', 'value'),
-  State('dimensions', 'data'),
+  State('session-id', 'data'),
+  State('figure-legend', 'data'),
   prevent_initial_call=True
 )
-def update_campus_filter(campus_value, dimensions=None):
-  # Update data processor with new campus filter
-  global embedding_df
-  embedding_df = data_processor.update_from_dropdown(campus_value)
-  
-  # Create new bubble plot with updated data
-  new_figure = bubble(1200)
-  if dimensions is not None:
-    w, h = dimensions
-    scale_factor = w / 1200
-    new_figure['data'][0]['marker']['size'] = bubble_size * scale_factor
-    new_figure['data'][0]['textfont']['size'] = font_size * scale_factor
+@metrics.instrument('update_campus_filter')
+def update_campus_filter(campus_value, session_id, legend):
+  # Update this session's data processor with new campus filter
+  with session_job(session_id, 'campus') as data_processor:
+    embedding_df = data_processor.update_from_dropdown(campus_value)
+    data_version = data_processor.data_version
+    with metrics.stage('table_records'):
+      current_data = table_records(data_processor)
+      new_columns = [{"name": i, "id": i} for i in data_processor.df_current.columns if i not in editable_table_exclude_cols]
   
-  # Update table data and columns
-  current_data = data_processor.df_current.to_dict('records')
-  new_columns = [{"name": i, "id": i} for i in data_processor.df_current.columns if i not in editable_table_exclude_cols]
+  # Patch the bubble plot with updated data
+  with metrics.stage('figure'):
+    new_figure, legend = bubble_patch(embedding_df, legend)
   
-  return new_figure, current_data, new_columns
+  return new_figure, current_data, new_columns, legend, data_version
 
 # upload
-def parse_contents(contents, filename, date):
-  content_type, content_string = contents.split(',')
-  decoded = base64.b64decode(content_string)
+def upload_errors(errors):
+  """Validation errors of a rejected upload, one line each"""
+  return [html.Div("The uploaded table was not loaded:")] + [html.Div(format_error(error)) for error in errors]
+
+
+@metrics.instrument('apply_table_edits')
+def apply_table_edits(data_timestamp, current_data, previous_data, session_id, legend):
+  # Only the changed cells are sent to the session's processor
+  changes = table_edits(current_data, previous_data)
+  if not changes:
+    raise PreventUpdate
   try:
-    if 'csv' in filename:
-      # Assume that the user uploaded a CSV file
-      df = pd.read_csv(
-        io.StringIO(decoded.decode('utf-8')))
-    elif 'xls' in filename:
-      # Assume that the user uploaded an excel file
-      df = pd.read_excel(io.BytesIO(decoded))
-  except Exception as e:
-    print(e)
-    return html.Div([
-      'There was an error processing this file.'
-    ])
-
-  return df
+    # each edit only carries its own cells: a superseded edit would be lost
+    with session_job(session_id, 'table', supersede=False) as data_processor:
+      embedding_df = data_processor.apply_edits(changes)
+      data_version = data_processor.data_version
+      # a campus edit can move rows in or out of the filtered view
+      with metrics.stage('table_records'):
+        current_data = table_records(data_processor) if any(c['column'] == 'campus' for c in changes) else no_update
+  except EditError as e:
+    # nothing was changed: put the previous cell values back
+    logger.info("table edit rejected: %s", e)
+    error_style = {'color': 'red', 'font-size': '12px', 'padding': '8px'}
+    error = [html.Div("The edit was not applied:")] + [html.Div(format_error(error)) for error in e.errors]
+    return previous_data, no_update, no_update, no_update, error, error_style
+  
+  with metrics.stage('figure'):
+    new_figure, legend = bubble_patch(embedding_df, legend)
+  return current_data, new_figure, legend, data_version, None, {'display': 'none'}
 
 
-@app.callback(
+@metrics.instrument('update_table_page')
+def update_table_page(page_current, page_size, sort_by, filter_query, data_version, session_id):
+  with sessions.read(session_id) as data_processor:
+    with metrics.stage('table_records'):
+      return data_processor.table_page(page_current or 0, page_size or table_page_size, sort_by, filter_query)
+
+
+app.callback(
   [Output('editable-table', 'data', allow_duplicate=True),
-   Output("bubble", "figure", allow_duplicate=True)],
+   Output("bubble", "figure", allow_duplicate=True),
+   Output('figure-legend', 'data', allow_duplicate=True),
+   Output('data-version', 'data', allow_duplicate=True),
+   Output("table-error-message", "children"),
+   Output("table-error-message", "style")],
   Input('editable-table', 'data_timestamp'),
   [State('editable-table', 'data'),
-   State('dimensions', 'data')],
+   State('editable-table', 'data_previous'),
+   State('session-id', 'data'),
+   State('figure-legend', 'data')],
   prevent_initial_call=True
-)
-def update_table_and_graph(data_timestamp, current_data, dimensions=None):  
-  # Re-embed with MDS using the updated data
-  global embedding_df
-  embedding_df = data_processor.update_from_table_data(current_data)
-  
-  # Create new bubble plot with updated data
-  new_figure = bubble(1200)
-  if dimensions is not None:
-    w, h = dimensions
-    scale_factor = w / 1200
-    new_figure['data'][0]['marker']['size'] = bubble_size * scale_factor
-    new_figure['data'][0]['textfont']['size'] = font_size * scale_factor
-  return current_data, new_figure
+)(apply_table_edits)
+if table_page_size:
+  app.callback(
+    [Output('editable-table', 'data', allow_duplicate=True),
+     Output('editable-table', 'page_count')],
+    [Input('editable-table', 'page_current'),
+     Input('editable-table', 'page_size'),
+     Input('editable-table', 'sort_by'),
+     Input('editable-table', 'filter_query'),
+     Input('data-version', 'data')],
+    State('session-id', 'data'),
+    prevent_initial_call=True
+  )(update_table_page)
 
 
 @app.callback(
   [Output('editable-table', 'data', allow_duplicate=True),
    Output('editable-table', 'columns', allow_duplicate=True),  # Add this line
-   Output("bubble", "figure", allow_duplicate=True)],
+   Output("bubble", "figure", allow_duplicate=True),
+   Output('figure-legend', 'data', allow_duplicate=True),
+   Output('data-version', 'data', allow_duplicate=True),
+   Output("upload-error-message", "children"),
+   Output("upload-error-message", "style")],
   Input('upload-table', 'contents'),
   State('upload-table', 'filename'),
-  State('upload-table', 'last_modified'),
-  State('editable-table', 'data'),
-  State('dimensions', 'data'),
+  State('upload-append', 'value'),
+  State('session-id', 'data'),
+  State('figure-legend', 'data'),
   prevent_initial_call=True
 )
-def update_table(content, name, date, current_data, dimensions=None):
+@metrics.instrument('update_table')
+def update_table(content, name, append, session_id, legend):
   if content is not None:
-    upload_df = parse_contents(content, name, date)
-    global embedding_df
-    embedding_df = data_processor.update_from_upload(upload_df)
-    
-    # Create new bubble plot with updated data
-    new_figure = bubble(1200)
-    if dimensions is not None:
-      w, h = dimensions
-      scale_factor = w / 1200
-      new_figure['data'][0]['marker']['size'] = bubble_size * scale_factor
-      new_figure['data'][0]['textfont']['size'] = font_size * scale_factor
+    try:
+      with metrics.stage('parse_upload'):
+        upload_df = read_upload(content, name)
+      with session_job(session_id, 'upload') as data_processor:
+        embedding_df = data_processor.update_from_upload(upload_df, append='append' in (append or []))
+        data_version = data_processor.data_version
+        with metrics.stage('table_records'):
+          current_data = table_records(data_processor)
+          new_columns = [{"name": i, "id": i} for i in data_processor.df_current.columns if i not in editable_table_exclude_cols]
+    except UploadError as e:
+      # nothing is embedded for a rejected file
+      logger.info("upload %r rejected: %s", name, e)
+      error_style = {'color': 'red', 'font-size': '12px', 'padding': '8px'}
+      return no_update, no_update, no_update, no_update, no_update, upload_errors(e.errors), error_style
     
-    current_data = data_processor.df_current.to_dict('records')
-    new_columns = [{"name": i, "id": i} for i in data_processor.df_current.columns if i not in editable_table_exclude_cols]
-
-    return current_data, new_columns, new_figure
+    # Patch the bubble plot with updated data
+    with metrics.stage('figure'):
+      new_figure, legend = bubble_patch(embedding_df, legend)
 
-# download original table as CSV
-@app.callback(
-  Output("download-orig-table", "data"),
-  Input("btn-download-orig", "n_clicks"),
-  prevent_initial_call=True,
-)
-def func(n_clicks):
-  return dcc.send_file(data_dir.joinpath("area2category_score_campus.csv"))
+    return current_data, new_columns, new_figure, legend, data_version, None, {'display': 'none'}
 
-
-# download current table as CSV
-@app.callback(
-  Output("download-curr-table", "data"),
-  Input("btn-download-curr", "n_clicks"),
+# download links follow the selected format
+app.clientside_callback(
+  """
+  function(fmt, origHref, currHref) {
+      function withFormat(href) {
+          var url = new URL(href, window.location.href);
+          url.searchParams.set('format', fmt);
+          return url.pathname + url.search;
+      }
+      return [withFormat(origHref), withFormat(currHref)];
+  }
+  """,
+  [Output("link-download-orig", "href"),
+   Output("link-download-curr", "href")],
+  Input("download-format", "value"),
+  State("link-download-orig", "href"),
+  State("link-download-curr", "href"),
   prevent_initial_call=True,
 )
-def func(n_clicks):
-  cols2include = pd.read_csv(data_dir.joinpath("area2category_score_campus.csv")).columns.tolist()
-  df_curr = data_processor.df_current[cols2include]
-  return dcc.send_data_frame(df_curr.to_csv, "area2category_score_campus_current.csv", index=False)
 
 
 # type in MDS seed
@@ -402,63 +753,155 @@ def func(n_clicks):
   [Output("bubble", "figure", allow_duplicate=True),
    Output("mds-seed-input", "value", allow_duplicate=True),
    Output("input-error-message", "children"),
-   Output("input-error-message", "style")],
+   Output("input-error-message", "style"),
+   Output('figure-legend', 'data', allow_duplicate=True)],
   Input("mds-seed-input", "value"),
-  State('dimensions', 'data'),
+  State('session-id', 'data'),
+  State('figure-legend', 'data'),
+  State('embedding-bank', 'data'),
+  State('bank-index', 'data'),
   prevent_initial_call=True
 )
-def type_mds_seed(mds_seed, dimensions=None):
+@metrics.instrument('type_mds_seed')
+def type_mds_seed(mds_seed, session_id, legend, bank, bank_index):
   error_style = {
     'color': 'red',
     'font-size': '12px',
     'padding': '8px',
   }
   # Re-embed with the new seed
-  global embedding_df
   try:
     mds_seed = int(float(mds_seed))
-    embedding_df = data_processor.update_from_mds_seed(mds_seed)
-    error_style['display'] = 'none'
-    error_message = ""
   except ValueError:
     error_message = "MDS seed must be an integer"
-    return no_update, no_update, error_message, error_style
+    return no_update, no_update, error_message, error_style, no_update
+  error_style['display'] = 'none'
+  error_message = ""
+  banked = bool(bank) and bank['seeds'][bank_index] == mds_seed
+  with session_job(session_id, 'seed') as data_processor:
+    if data_processor.mds_seed == mds_seed:
+      # set by change_mds_seed, or typed again: the page already shows this seed
+      return no_update, no_update, error_message, error_style, no_update
+    # the embedding bank already drew this layout in the browser: the session
+    # adopts its banked coordinates, no MDS run
+    if banked and data_processor.update_from_bank(mds_seed):
+      return no_update, no_update, error_message, error_style, no_update
+    embedding_df = data_processor.update_from_mds_seed(mds_seed)
   
-  # Create new bubble plot with updated data
-  new_figure = bubble(1200)
-  if dimensions is not None:
-    w, h = dimensions
-    scale_factor = w / 1200
-    new_figure['data'][0]['marker']['size'] = bubble_size * scale_factor
-    new_figure['data'][0]['textfont']['size'] = font_size * scale_factor
+  # a new seed only moves the bubbles
+  with metrics.stage('figure'):
+    new_figure, legend = bubble_patch(embedding_df, legend, coords_only=True)
   
-  return new_figure, str(data_processor.mds_seed), error_message, error_style
+  return new_figure, str(mds_seed), error_message, error_style, legend
 
 # button random change MDS seed
-@app.callback(
-  [Output("bubble", "figure", allow_duplicate=True),
-   Output("mds-seed-input", "value", allow_duplicate=True)],
-  Input("mds-seed-button", "n_clicks"),
-  State('dimensions', 'data'),
-  prevent_initial_call=True
-)
-def change_mds_seed(n_clicks, dimensions=None):
-  if n_clicks == 0:
-    return no_update
+def change_mds_seed(n_clicks, session_id, legend):
+  if not n_clicks:
+    raise PreventUpdate
   
   # Re-embed with a new seed
-  global embedding_df
-  embedding_df = data_processor.update_from_mds_seed()
+  with session_job(session_id, 'seed') as data_processor:
+    if mds_seed_candidates > 1:
+      embedding_df = data_processor.update_from_best_seed(n_seeds=mds_seed_candidates, criterion=mds_seed_criterion)
+    else:
+      embedding_df = data_processor.update_from_mds_seed()
+    mds_seed = data_processor.mds_seed
   
-  # Create new bubble plot with updated data
-  new_figure = bubble(1200)
-  if dimensions is not None:
-    w, h = dimensions
-    scale_factor = w / 1200
-    new_figure['data'][0]['marker']['size'] = bubble_size * scale_factor
-    new_figure['data'][0]['textfont']['size'] = font_size * scale_factor
+  # a new seed only moves the bubbles
+  with metrics.stage('figure'):
+    new_figure, legend = bubble_patch(embedding_df, legend, coords_only=True)
   
-  return new_figure, str(data_processor.mds_seed)
+  return new_figure, str(mds_seed), legend
+
+
+# (re)build the embedding bank for the session's current data; large embeddings are
+# drawn as clusters, which banked per-row layouts cannot patch, so they get no bank
+def update_embedding_bank(data_version, session_id):
+  with session_job(session_id, 'bank') as data_processor:
+    if len(data_processor.embedding_df) > large_data_threshold:
+      return None, 0
+    seeds, layouts = data_processor.embedding_bank(embedding_bank_size)
+    data_version = data_processor.data_version
+  bank = {
+    'data_version': data_version,  # layouts only fit the rows of this version
+    'seeds': seeds,
+    'shape': list(layouts.shape),
+    'data': base64.b64encode(layouts.astype('<f4').tobytes()).decode('ascii'),
+  }
+  return bank, 0
+
+
+if embedding_bank_size > 0:
+  app.callback(
+    [Output('embedding-bank', 'data'),
+     Output('bank-index', 'data', allow_duplicate=True)],
+    Input('data-version', 'data'),
+    State('session-id', 'data'),
+    prevent_initial_call='initial_duplicate',
+  )(metrics.instrument('update_embedding_bank')(update_embedding_bank))
+  
+  # swap to the next banked layout in the browser, no server round trip for the figure;
+  # without a bank the click is passed on to change_mds_seed through the seed-request store
+  app.clientside_callback(
+    """
+    function(n_clicks, bank, index, dataVersion, figure) {
+        var no_update = window.dash_clientside.no_update;
+        if (!n_clicks) {
+            return [no_update, no_update, no_update, no_update];
+        }
+        // rows of the trace: a plain array, or a typed array spec {dtype, bdata}
+        var x = figure && figure.data.length ? figure.data[0].x : null;
+        var rows = Array.isArray(x) ? x.length : (x && x.bdata ?
+            (x.bdata.length * 3 / 4 - (x.bdata.match(/=*$/)[0].length)) / parseInt(x.dtype.slice(1), 10) : -1);
+        // a bank built for other data (not rebuilt yet after a campus change,
+        // edit or upload) would draw the wrong rows: embed on the server instead
+        if (!bank || bank.data_version !== dataVersion || bank.shape[1] !== rows) {
+            return [no_update, no_update, no_update, n_clicks];
+        }
+        var next = (index + 1) % bank.seeds.length;
+        var raw = atob(bank.data);
+        var bytes = new Uint8Array(raw.length);
+        for (var i = 0; i < raw.length; i++) {
+            bytes[i] = raw.charCodeAt(i);
+        }
+        var layouts = new Float32Array(bytes.buffer);
+        var n = bank.shape[1], offset = next * n * 2;
+        var x = new Array(n), y = new Array(n);
+        for (var j = 0; j < n; j++) {
+            x[j] = layouts[offset + 2 * j];
+            y[j] = layouts[offset + 2 * j + 1];
+        }
+        var patch = new window.dash_clientside.Patch()
+            .assign(['data', 0, 'x'], x)
+            .assign(['data', 0, 'y'], y)
+            .build();
+        return [patch, String(bank.seeds[next]), next, no_update];
+    }
+    """,
+    [Output("bubble", "figure", allow_duplicate=True),
+     Output("mds-seed-input", "value", allow_duplicate=True),
+     Output('bank-index', 'data', allow_duplicate=True),
+     Output('seed-request', 'data')],
+    Input("mds-seed-button", "n_clicks"),
+    State('embedding-bank', 'data'),
+    State('bank-index', 'data'),
+    State('data-version', 'data'),
+    State("bubble", "figure"),
+    prevent_initial_call=True
+  )
+
+# server-side seed change: on every click without an embedding bank, else on the
+# seed-request store, for clicks the bank cannot serve (large, clustered embeddings)
+seed_trigger = Input('seed-request', 'data') if embedding_bank_size > 0 else Input("mds-seed-button", "n_clicks")
+app.callback(
+  [Output("bubble", "figure", allow_duplicate=True),
+   Output("mds-seed-input", "value", allow_duplicate=True),
+   Output('figure-legend', 'data', allow_duplicate=True)],
+  seed_trigger,
+  State('session-id', 'data'),
+  State('figure-legend', 'data'),
+  prevent_initial_call=True
+)(metrics.instrument('change_mds_seed')(change_mds_seed))
 
 
 
@@ -472,6 +915,7 @@ def change_mds_seed(n_clicks, dimensions=None):
   Input("toggle-table-btn", "n_clicks"),
   State("table-visible", "data")
 )
+@metrics.instrument('toggle_table')
 def toggle_table(n_clicks, is_visible):
   if n_clicks == 0:
     return {'display': 'none'}, "edit score table", False
@@ -482,106 +926,166 @@ def toggle_table(n_clicks, is_visible):
     return {'display': 'flex'}, "hide score table", True
 
 
-# add event listener for window resizing
+# window resizing is handled in the browser: resize events are coalesced to one
+# per animation frame, and the bubble and text sizes are patched only when the
+# window width changed, so resizing never calls the server
 app.clientside_callback(
     """
     function(trigger) {
-        function dummyClick() {
-            document.getElementById('dummy').click()
-        };
-        
-        window.addEventListener('resize', dummyClick)
-        return window.dash_clientside.no_update
+        if (!window.bubbleResizeListener) {
+            var pending = false;
+            window.bubbleResizeListener = function() {
+                if (pending) {
+                    return;
+                }
+                pending = true;
+                window.requestAnimationFrame(function() {
+                    pending = false;
+                    document.getElementById('dummy').click();
+                });
+            };
+            window.addEventListener('resize', window.bubbleResizeListener);
+        }
+        return window.dash_clientside.no_update;
     }
     """,
     Output("dummy", "style"), # do not allow_duplicate, do not prevent_initial_call
     Input("dummy", "style"),
 )
 
-
-# store current dimension in store
 app.clientside_callback(
     """
-    function updateStore(click) {
+    function(click, scale) {
         var w = window.innerWidth;
-        var h = window.innerHeight; 
-        return [w, h]
+        if (w === window.bubbleScaleWidth) {
+            return window.dash_clientside.no_update;
+        }
+        window.bubbleScaleWidth = w;
+        var factor = w / scale.width;
+        return new window.dash_clientside.Patch()
+            .assign(['data', 0, 'marker', 'sizeref'], scale.sizeref / factor)
+            .assign(['data', 0, 'textfont', 'size'], scale.font_size * factor)
+            .build();
     }
     """,
-    Output('dimensions', 'data'),
-    Input('dummy', 'n_clicks')
+    Output("bubble", "figure", allow_duplicate=True),
+    Input('dummy', 'n_clicks'),
+    State('bubble-scale', 'data'),
+    prevent_initial_call='initial_duplicate',
 )
 
-# window resize handler
-@app.callback(
-    Output("bubble", "figure", allow_duplicate=True),
-    Input('dimensions', 'data'),
-    prevent_initial_call=True
+
+# large embeddings: re-cluster and label the zoomed-in region. Only axis changes of a
+# clustered (WebGL) plot reach the server, small plots zoom in the browser alone
+app.clientside_callback(
+  """
+  function(relayout, figure) {
+      var no_update = window.dash_clientside.no_update;
+      if (!relayout || !figure || !figure.data.length || figure.data[0].type !== 'scattergl') {
+          return no_update;
+      }
+      var zoomed = Object.keys(relayout).some(function(key) {
+          return key.startsWith('xaxis.') || key.startsWith('yaxis.');
+      });
+      return zoomed ? relayout : no_update;
+  }
+  """,
+  Output('zoom-request', 'data'),
+  Input("bubble", "relayoutData"),
+  State("bubble", "figure"),
+  prevent_initial_call=True
 )
-def resize_graph(dimensions):
-  if dimensions is None:
-    return bubble(1200)
-
-  w, h = dimensions
-  patched = Patch()
-  scale_factor = w / 1200
-  # print(f"scale factor: {scale_factor:.2f} bubble size: {round(bubble_size*scale_factor)} font size: {round(font_size*scale_factor)}")
-  # # scale marker size depending on window width (w)
-  # for i in range(len(embedding_df['category'].unique())):
-  #   patched['data'][i]['marker']['size'] = bubble_size * scale_factor
-  #   patched['data'][i]['textfont']['size'] = font_size * scale_factor
-  # Only update the main scatter trace (index 0), not the legend traces
-  patched['data'][0]['marker']['size'] = bubble_size * scale_factor
-  patched['data'][0]['textfont']['size'] = font_size * scale_factor
 
-  return patched
 
-# bubble click handler
 @app.callback(
-  Output("click-info", "children"),
-  Input("bubble", "clickData")
+  Output("bubble", "figure", allow_duplicate=True),
+  Input('zoom-request', 'data'),
+  State('session-id', 'data'),
+  prevent_initial_call=True
 )
-def update_sidebar(clickData):
-  if clickData is None:
-    return []#[html.P("click on a bubble to see PIs...", 
-            #        style={"fontSize": "14px", "color": "darkslategray"}
-            #        )
-            # ]
-  
-  # Extract the clicked point data
-  point = clickData['points'][0]
+@metrics.instrument('zoom_large_data')
+def zoom_large_data(relayout, session_id):
+  if not relayout:
+    raise PreventUpdate
+  with sessions.read(session_id) as data_processor:
+    embedding_df = data_processor.embedding_df
+  if len(embedding_df) <= large_data_threshold:
+    raise PreventUpdate
   
-  # Get the customdata which contains [area, category]
-  if 'customdata' in point:
-    area = point['customdata'][0]
-    category = point['customdata'][1]
-    
-    # Get PIs for this area
-    pis = area2pis_dict.get(area, [])
-    pis = sorted(pis)
-    
-    # Create the info display
-    info_children = [
-      html.P(area, style={'margin-bottom': '10px'}),
-      # html.P(f"Category: {category}", style={'margin-bottom': '15px', 'font-style': 'italic'}),
-    ]
-    
-    if pis:
-      # info_children.append(html.H6("Principal Investigators:", )) #style={'margin-bottom': '10px'}
-      pi_links = []
-      for pi in pis:
-        if pi in pi2url_dict:
-          pi_links.append(
-            html.A(pi, href=pi2url_dict[pi], target="_blank", 
-                 style={'display': 'block', 'margin-bottom': '5px'})
-          )
-        else:
-          pi_links.append(html.Div(pi, style={'margin-bottom': '5px'}))
-      info_children.extend(pi_links)
-    
-    return info_children
+  x_range = y_range = None
+  if "xaxis.range[0]" in relayout:
+    x_range = (relayout["xaxis.range[0]"], relayout["xaxis.range[1]"])
+  if "yaxis.range[0]" in relayout:
+    y_range = (relayout["yaxis.range[0]"], relayout["yaxis.range[1]"])
+  with metrics.stage('figure'):
+    trace = trace_data(embedding_df, category_colors(embedding_df), x_range, y_range)
+    patched = patch_trace(Patch(), trace)
+  return patched
+
+# bubble click handler: customdata is [area, category]; areas without PIs only show their name
+app.clientside_callback(
+  """
+  function(clickData, content) {
+      if (!clickData || !clickData.points.length || !clickData.points[0].customdata) {
+          return [];
+      }
+      var area = clickData.points[0].customdata[0];
+      return content[area] || [{
+          type: 'P', namespace: 'dash_html_components',
+          props: {children: area, style: {'margin-bottom': '10px'}}
+      }];
+  }
+  """,
+  Output("click-info", "children"),
+  Input("bubble", "clickData"),
+  State("sidebar-content", "data"),
+)
+
+# per-callback stage timings, payload sizes, cache and session gauges
+@app.server.after_request
+def record_callback_metrics(response):
+  if request.path.endswith('/_dash-update-component'):
+    metrics.finish_request(response.calculate_content_length() or 0)
+  elif request.path.startswith(app.get_relative_path('/download/')):
+    metrics.finish_request(response.content_length or 0)
+  return response
+
+
+@app.server.route(app.get_relative_path('/download/<table>'))
+@metrics.instrument('download')
+def download_table(table):
+  """Stream the original or a session's current table as csv, csv.gz or parquet
   
-  return
+  Exports are cached per session until its data_version changes, and the
+  original csv is served from disk with conditional (304) responses.
+  """
+  fmt = request.args.get('format', 'csv')
+  session_id = request.args.get('session')
+  if fmt not in EXPORT_FORMATS or table not in ('original', 'current') or (table == 'current' and not session_id):
+    abort(404)
+  mimetype, suffix = EXPORT_FORMATS[fmt]
+  name = f"area2category_score_campus{'_current' if table == 'current' else ''}{suffix}"
+  if table == 'original' and fmt == 'csv':
+    return send_file(csv_path, mimetype=mimetype, as_attachment=True, download_name=name, conditional=True)
+  if table == 'original':
+    data = data_processor.export(fmt)  # the base processor never changes
+  else:
+    with sessions.read(session_id) as session_processor:
+      data = session_processor.export(fmt)
+  return send_file(io.BytesIO(data), mimetype=mimetype, as_attachment=True, download_name=name)
+
+
+# numbers of the worker process that serves the request, not of the whole server
+@app.server.route('/metrics')
+def metrics_endpoint():
+  return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+startup_timings["total"] = time.perf_counter() - startup_begin
+logger.info("startup: " + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in startup_timings.items()))
+metrics.gauge("startup_seconds", "Import and startup time of the app by stage.",
+              lambda: {(("stage", stage),): round(seconds, 6) for stage, seconds in startup_timings.items()})
+
 
 if __name__ == "__main__":
   port = int(os.environ.get('PORT', 8050))
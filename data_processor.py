@@ -1,101 +1,793 @@
+import copy
+import functools
+import gzip
+import io
+import logging
+import numpy as np
+import os
 import pandas as pd
 import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import find_spec
 from pathlib import Path
-from sklearn.manifold import MDS
+
+from embedding_cache import default_cache, file_checksum
+from embedding_engines import ENGINES, get_engine, kruskal_stress, pairwise_distances
+from embedding_jobs import process_context, shared_call
+from ingest import AREA_COLUMNS, MAX_ERRORS, EditError, UploadError, not_a_score
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# download formats: name -> (mimetype, file suffix); parquet needs pyarrow or fastparquet
+EXPORT_FORMATS = {
+  'csv': ('text/csv', '.csv'),
+  'csv.gz': ('application/gzip', '.csv.gz'),
+}
+if find_spec('pyarrow') or find_spec('fastparquet'):
+  EXPORT_FORMATS['parquet'] = ('application/vnd.apache.parquet', '.parquet')
+
+
+def export_table(df, fmt='csv'):
+  """Serialize a score table in one of EXPORT_FORMATS"""
+  if fmt not in EXPORT_FORMATS:
+    raise ValueError(f"unknown export format {fmt!r}, expected one of {sorted(EXPORT_FORMATS)}")
+  if fmt == 'parquet':
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+  data = df.to_csv(index=False).encode('utf-8')
+  return gzip.compress(data, compresslevel=6, mtime=0) if fmt == 'csv.gz' else data
+
+
+# DataTable filter_query operators (custom filter_action), longest spellings first
+FILTER_OPERATORS = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'], ['ne ', '!='], ['eq ', '='],
+                    ['contains '], ['datestartswith ']]
+
+
+def split_filter_part(filter_part):
+  """Parse one `{column} op value` clause of a DataTable filter_query into (column, op, value, case)
+
+  `case` is False for the case-insensitive `i` operator prefix (`icontains`, `i=`)
+  and True otherwise. Values of `contains` and `datestartswith` are kept as
+  text, the others are converted to float where they parse as numbers.
+  """
+  # operators are looked up after the column name, which may contain "ne ", "<" etc.
+  end = filter_part.find('}') + 1
+  for operator_type in FILTER_OPERATORS:
+    for operator in operator_type:
+      if operator in filter_part[end:]:
+        prefix, value_part = filter_part[end:].split(operator, 1)
+        name = filter_part[filter_part.find('{') + 1: end - 1]
+        prefix = prefix.strip()
+        value_part = value_part.strip()
+        v0 = value_part[:1]
+        if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+          value = value_part[1:-1].replace('\\' + v0, v0)
+        elif operator_type[0] in ('contains ', 'datestartswith '):
+          value = value_part  # matched as typed: "3" must not become "3.0"
+        else:
+          try:
+            value = float(value_part)
+          except ValueError:
+            value = value_part
+        # word operators need spaces after them in the filter string, but we don't want them later
+        return name, operator_type[0].strip(), value, prefix != 'i'
+  return [None] * 4
+
+
+def compact_scores(values):
+  """Score matrix in the smallest dtype holding it: uint8/int16/int32 for whole numbers, else float32"""
+  values = np.asarray(values, dtype=np.float64)
+  if np.isnan(values).any() or not np.array_equal(values, np.round(values)):
+    return np.ascontiguousarray(values, dtype=np.float32)
+  lo, hi = values.min(initial=0), values.max(initial=0)
+  for dtype in (np.uint8, np.int16, np.int32):
+    if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+      return np.ascontiguousarray(values, dtype=dtype)
+  return np.ascontiguousarray(values, dtype=np.int64)
 
 
 class DataProcessor:
-  def __init__(self, csv_path, mds_seed=None, bubble_size=60, font_size=8):
+  """Score table, campus filter and MDS embedding of one session
+
+  The table is held as `areas`, a frame of categorical campus, area_shortname,
+  area and category columns, and `scores`, a compact (rows, score columns)
+  NumPy matrix, both indexed by row position. The campus filter is an array of
+  positions, and pandas frames (`df_current`, `embedding_df`) are only built for
+  Dash. Copies share the arrays until they are edited.
+  """
+  def __init__(self, csv_path, mds_seed=None, bubble_size=60, font_size=8, embedding_cache=None, engine=None,
+               precomputed_path=None):
     self.bubble_size = bubble_size
     self.font_size = font_size
     self.editable_table_exclude_cols = ['area', 'category', 'size', 'area_campus']
     self.mds_seed = random.randint(0, 10000) if mds_seed is None else mds_seed
+    self.engine = get_engine(engine)  # defaults to $EMBEDDING_ENGINE, else smacof
+    self.embedding_cache = default_cache if embedding_cache is None else embedding_cache
+    # warm-started single-init SMACOF for table edits; falls back to a full run
+    # if stress grows by more than warm_start_tolerance (relative) over the previous layout
+    self.warm_start_params = dict(max_iter=100, eps=1e-3)
+    self.warm_start_tolerance = 0.1
+    self.embedding = None  # raw MDS coordinates backing embedding_df
+    self.stress = None
+    # optional callable runner(fn, *args, **kwargs) used to run the engine, e.g. in a worker pool
+    self.runner = None
+    self.data_version = 0  # bumped whenever the scores or the campus filter change
+    # full-campus pairwise distances, kept for engines that use them (SMACOF, classical) up to
+    # DISTANCE_MATRIX_MAX_ROWS rows; memory-mapped to a temporary file in DISTANCE_MATRIX_DIR if set
+    self.distances = None
+    self.distance_max_rows = int(os.environ.get('DISTANCE_MATRIX_MAX_ROWS', 5000))
+    self.distance_dir = os.environ.get('DISTANCE_MATRIX_DIR')
+    self._shared = False  # arrays shared with a copy, copied before the first edit
+    self._exports = {}  # format -> (data_version, serialized current table)
+    # with CAMPUS_VIEW=1 every campus is embedded once and the campus filter shows a rescaled
+    # subset of that layout, optionally refined for CAMPUS_VIEW_REFINE_ITER warm-started iterations
+    self.campus_view = os.environ.get('CAMPUS_VIEW', '0') == '1'
+    self.campus_view_refine = int(os.environ.get('CAMPUS_VIEW_REFINE_ITER', 0))
+    self.embedding_all = None  # all-campus MDS coordinates in campus view mode
+    self.landmark_model = None  # (score columns, seed, model) of the last landmark MDS fit
+    self._bank = None  # (data_version, {seed: raw embedding}) of the last embedding bank
+    self.stress_all = None
+    
+    # Load precomputed embeddings (see precompute.py) if they were built from this csv
+    if precomputed_path is not None:
+      self.embedding_cache.load(precomputed_path, file_checksum(csv_path))
     
     # Load and process initial data
-    self.df_original = self._load_data(csv_path)
-    self.df_current = self.df_original.copy()
-    self.df_current_allcampus = self.df_current.copy()
-    self.categories = sorted(self.df_original["category"].unique())
-    self.embedding_df = self._compute_embedding(self.df_current)
+    self.original = self._load_data(csv_path)  # (areas, scores, score_columns) as loaded
+    self._set_data(*self.original)
+    self._shared = True  # the current table shares its frame and arrays with self.original
+    self.embedding_df = self._compute_embedding()
     
+  def __getstate__(self):
+    # the embedding cache is process-wide, do not pickle it with session state
+    state = self.__dict__.copy()
+    state['embedding_cache'] = None if self.embedding_cache is default_cache else self.embedding_cache
+    state['runner'] = None
+    state['distances'] = None  # recomputed on first use rather than pickled at O(n^2)
+    state['_exports'] = {}
+    return state
+  
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    # pickling keeps the identity of the unedited table with self.original
+    self._shared = self.areas is self.original[0]
+    if self.embedding_cache is None:
+      self.embedding_cache = default_cache
+  
+  def _frame(self, areas, scores, score_columns):
+    """Score table as a DataFrame: area columns, score columns, category"""
+    return pd.concat([
+      areas[AREA_COLUMNS],
+      pd.DataFrame(scores, columns=score_columns, index=areas.index),
+      areas[['category']],
+    ], axis=1)
+  
+  @property
+  def df_original(self):
+    """Score table as loaded from the csv"""
+    return self._frame(*self.original)
+  
+  @property
+  def df_current(self):
+    """Score table rows selected by the campus filter"""
+    if self.current_rows is None:
+      return self._frame(self.areas, self.scores, self.score_columns)
+    return self._frame(self.areas.iloc[self.current_rows], self.scores[self.current_rows], self.score_columns)
+  
+  def _set_data(self, areas, scores, score_columns):
+    """Replace the table (all campuses) and its row-normalized scores"""
+    self.areas = areas
+    self.scores = scores
+    self.score_columns = list(score_columns)
+    self.categories = sorted(areas['category'].unique())
+    self.campus = 'IUB/IUI'  # campus filter of the dropdown
+    self.current_rows = None  # row positions of the campus filter, None for all rows
+    self.norm_columns = [col for col in self.score_columns if col in self.categories]
+    self._norm_index = np.array([self.score_columns.index(col) for col in self.norm_columns], dtype=np.intp)
+    self.scores_norm = self._normalize_scores(self.scores[:, self._norm_index])
+    self.distances = None  # recomputed lazily by _current_distances
+    self._shared = False
+  
+  def copy(self):
+    """Independent copy for a new session; read-only data and the cache are shared"""
+    new = copy.copy(self)
+    new.distances = self.distances  # dropped by __getstate__, shared here until _unshare
+    # areas and the arrays are copied by _unshare on the first edit (pandas < 3 has no copy-on-write)
+    new.areas = self.areas.copy(deep=False)
+    new.embedding_df = self.embedding_df.copy(deep=False)
+    self._shared = new._shared = True
+    new.categories = list(self.categories)
+    new._exports = dict(self._exports)
+    new.runner = None
+    return new
+  
+  def _unshare(self):
+    if self._shared:
+      self.areas = self.areas.copy()
+      self.scores = self.scores.copy()
+      self.scores_norm = self.scores_norm.copy()
+      if self.distances is not None:
+        # a memory-mapped matrix is copied into a new mapping, not onto the heap
+        distances = self._allocate_distances(len(self.distances))
+        distances[:] = self.distances
+        self.distances = distances
+      self._shared = False
+  
+  def nbytes(self):
+    """Approximate memory held by this processor; arrays shared with other sessions are not counted"""
+    arrays = (self.scores, self.scores_norm, self.distances)
+    own = 0 if self._shared else sum(array.nbytes for array in arrays if array is not None)
+    frames = (self.areas, self.embedding_df)
+    return int(sum(df.memory_usage(deep=True).sum() for df in frames)) + own
+  
   def _load_data(self, csv_path):
     """Load and prepare the initial dataframe"""
     df = pd.read_csv(Path(csv_path)) #, index_col=["campus", "area_shortname", "area"]
-    df = self._process_loaded_df(df)
-    return df
+    self.original_columns = list(df.columns)  # column order of exports
+    return self._process_loaded_df(df)
   
   def _process_loaded_df(self, df):
-    df = df.set_index(["campus", "area_shortname", "area"])
-    df = df.astype(int)
-    df['category'] = df.idxmax(axis=1)
-    df = df.reset_index()
-    df['size'] = self.bubble_size
-    df['area_campus'] = df['area_shortname'] + "<br>(" + df['campus'] + ")"
-    df = df.sort_values(by=['campus', 'area_shortname'])
-    return df
-  
-  def _compute_embedding(self, df, mds_seed=None):
-    """Compute MDS embedding from dataframe"""
-    
-    if all(col in df.columns for col in ["campus", "area_shortname", "area"]):
-      df = df.set_index(["campus", "area_shortname", "area"])
-    # Get score columns only
-    score_columns = [col for col in df.columns if col in self.categories]
-    df_scores = df[score_columns]
-    df_scores = df_scores.apply(pd.to_numeric, errors='coerce')
-    df_norm = df_scores.div(df_scores.sum(axis=1), axis=0)
-    
-    # MDS embedding
+    """Sort a score table by campus and area and split it into (areas, scores, score columns)"""
+    df = df.sort_values(by=['campus', 'area_shortname'], kind='stable', ignore_index=True)
+    return self._split_frame(df)
+  
+  def _split_frame(self, df, score_columns=None):
+    """Categorical area columns and compact score matrix of a score table
+    
+    `category` is recomputed as each row's highest-scoring column.
+    """
+    if score_columns is None:
+      score_columns = [col for col in df.columns if col not in AREA_COLUMNS]
+    scores = compact_scores(df[score_columns].apply(pd.to_numeric, errors='coerce'))
+    areas = pd.DataFrame({col: pd.Categorical(df[col].astype(str)) for col in AREA_COLUMNS})
+    areas['category'] = pd.Categorical.from_codes(self._argmax(scores), categories=score_columns)
+    return areas, scores, score_columns
+  
+  @staticmethod
+  def _argmax(scores):
+    """Index of each row's highest score (NaN counted as 0), like DataFrame.idxmax"""
+    if scores.dtype.kind == 'f':
+      scores = np.nan_to_num(scores)
+    return scores.argmax(axis=1)
+  
+  def _run(self, fn, *args, **kwargs):
+    if self.runner is None:
+      return fn(*args, **kwargs)
+    # a process-pool runner hands the distance matrix to its worker in shared memory
+    return self.runner(fn, *args, **kwargs)
+  
+  def _run_many(self, fn, *iterables, **kwargs):
+    # runners with a map() fan the calls out in parallel
+    if self.runner is None or not hasattr(self.runner, 'map'):
+      return list(map(functools.partial(fn, **kwargs), *iterables))
+    return self.runner.map(fn, *iterables, **kwargs)
+  
+  @staticmethod
+  def _normalize_scores(scores):
+    """Scale each row of a score matrix to sum to 1"""
+    scores = np.asarray(scores, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return scores / scores.sum(axis=1, keepdims=True)
+  
+  @staticmethod
+  def _scale(embedding):
+    """Min-max scale each axis to [0, 1]"""
+    return (embedding - embedding.min(axis=0)) / (embedding.max(axis=0) - embedding.min(axis=0))
+  
+  def _normalized(self, all_rows=False):
+    """Current campus view (or every row) as (areas, score columns, row-normalized score matrix)"""
+    if all_rows or self.current_rows is None:
+      return self.areas, self.norm_columns, self.scores_norm
+    return self.areas.iloc[self.current_rows], self.norm_columns, self.scores_norm[self.current_rows]
+  
+  def _allocate_distances(self, n):
+    """Uninitialized float32 (n, n) matrix, memory-mapped to a temporary file in distance_dir if set"""
+    if not self.distance_dir:
+      return np.empty((n, n), dtype=np.float32)
+    # the file is unlinked on close, the mapping keeps it alive
+    with tempfile.TemporaryFile(dir=self.distance_dir) as f:
+      return np.memmap(f, dtype=np.float32, mode='w+', shape=(n, n))
+  
+  def _pairwise_distances(self, scores_norm, block_rows=1024):
+    """Distance matrix of all rows, or None if the engine does not use one or it would be too large"""
+    n = len(scores_norm)
+    if not self.engine.uses_distances or n > self.distance_max_rows:
+      return None
+    distances = self._allocate_distances(n)
+    for start in range(0, n, block_rows):
+      distances[start:start + block_rows] = pairwise_distances(scores_norm[start:start + block_rows], scores_norm)
+    np.fill_diagonal(distances, 0)
+    return distances
+  
+  def _current_distances(self, all_rows=False):
+    """Distances between the rows of the current campus view, sliced from the full-campus matrix"""
+    if self.distances is None:
+      with metrics.stage('distances'):
+        self.distances = self._pairwise_distances(self.scores_norm)
+      if self.distances is None:
+        return None
+    if all_rows or self.current_rows is None:
+      return self.distances
+    return self.distances[np.ix_(self.current_rows, self.current_rows)]
+  
+  def _update_distances(self, rows):
+    """Recompute the rows and columns of the distance matrix at positions `rows`"""
+    if self.distances is None:
+      return
+    block = pairwise_distances(self.scores_norm[rows], self.scores_norm)
+    block[np.arange(len(rows)), rows] = 0
+    self.distances[rows, :] = block
+    self.distances[:, rows] = block.T
+  
+  def _embedding_key(self, scores_norm, score_columns, seed):
+    return self.embedding_cache.make_key(scores_norm, score_columns, seed, self.engine.params())
+  
+  def _compute_embedding(self, mds_seed=None, init=None):
+    """Compute MDS embedding of the current view, warm-started from `init` coordinates if given"""
+    if not self.campus_view:
+      areas, self.embedding, self.stress = self._embed_rows(False, mds_seed, init, self.stress)
+      return self._embedding_frame(areas, self.embedding)
+    # campus view mode: embed every campus, warm-started from the previous all-campus layout
+    if init is not None and len(init) != len(self.areas):
+      init = self.embedding_all if self.embedding_all is not None and len(self.embedding_all) == len(self.areas) else None
+    _, self.embedding_all, self.stress_all = self._embed_rows(True, mds_seed, init, self.stress_all)
+    return self._campus_view_embedding()
+  
+  def _embed_rows(self, all_rows, mds_seed, init, previous_stress):
+    """(areas, raw embedding, stress) of the current view or of every row"""
+    with metrics.stage('normalize'):
+      distances = self._current_distances(all_rows)
+      areas, score_columns, df_norm = self._normalized(all_rows)
+    
+    # MDS embedding, reused when the same normalized scores were embedded with the same seed
     if mds_seed is not None:
       self.mds_seed = mds_seed
-    print(f"mds random seed: {self.mds_seed}")
-    embedding = MDS(n_components=2, n_init=4, random_state=self.mds_seed).fit_transform(df_norm)
-    
-    # Create embedding dataframe
-    embedding_df = pd.DataFrame(embedding, columns=["x", "y"])
-    embedding_df = (embedding_df - embedding_df.min()) / (embedding_df.max() - embedding_df.min())
-    embedding_df = pd.concat([
-      embedding_df, 
-      df.reset_index()[["area_campus", "campus", 'area', 'area_shortname', 'category', 'size']]
-    ], axis=1)
+    embedding = None
+    if init is not None and previous_stress is not None and self.engine.supports_warm_start:
+      with metrics.stage('mds_warm_start'):
+        embedding = self._run(self.engine.refine, df_norm, init, seed=self.mds_seed, distances=distances,
+                              **self.warm_start_params)
+      stress = kruskal_stress(df_norm, embedding, distances=distances)
+      if stress > previous_stress * (1 + self.warm_start_tolerance):
+        logger.info("warm-started mds stress %.4f > %.4f, recomputing", stress, previous_stress)
+        embedding = None
+    if embedding is None:
+      key = self._embedding_key(df_norm, score_columns, self.mds_seed)
+      embedding = self.embedding_cache.get(key)
+      metrics.annotate(cache_hit=embedding is not None)
+      if embedding is None:
+        logger.info("mds random seed: %s (%s)", self.mds_seed, self.engine.name)
+        with metrics.stage('mds'):
+          if hasattr(self.engine, 'project'):
+            # keep the landmark model, appended rows are projected against it
+            model = self._run(self.engine.fit, df_norm, seed=self.mds_seed)
+            self.landmark_model = (tuple(score_columns), self.mds_seed, model)
+            embedding = self.engine.project(model, df_norm)
+          else:
+            embedding = self._run(self.engine.embed, df_norm, seed=self.mds_seed, distances=distances)
+        self.embedding_cache.put(key, embedding)
+      stress = kruskal_stress(df_norm, embedding, distances=distances)
+    metrics.annotate(stress=round(stress, 4))
+    return areas, embedding, stress
+  
+  def _campus_view_embedding(self):
+    """Selected campus rows of the all-campus embedding, rescaled to the view"""
+    with metrics.stage('normalize'):
+      areas, _, df_norm = self._normalized()
+      distances = self._current_distances()
+    if self.current_rows is None:
+      embedding = self.embedding_all
+    else:
+      embedding = np.asarray(self.embedding_all)[self.current_rows]
+      if self.campus_view_refine and self.engine.supports_warm_start:
+        with metrics.stage('mds_warm_start'):
+          embedding = self._run(self.engine.refine, df_norm, embedding, seed=self.mds_seed, distances=distances,
+                                max_iter=self.campus_view_refine, eps=1e-3)
+    self.embedding = embedding
+    self.stress = self.stress_all if self.current_rows is None else kruskal_stress(df_norm, embedding, distances=distances)
+    return self._embedding_frame(areas, embedding)
+  
+  def _landmark_model(self):
+    """Landmark model of the whole table for the current seed, refitted unless the last fit matches"""
+    _, score_columns, df_norm = self._normalized(all_rows=True)
+    if self.landmark_model is None or self.landmark_model[:2] != (tuple(score_columns), self.mds_seed):
+      with metrics.stage('mds'):
+        model = self._run(self.engine.fit, df_norm, seed=self.mds_seed)
+      self.landmark_model = (tuple(score_columns), self.mds_seed, model)
+    return self.landmark_model[2]
+  
+  def _project_embedding(self, model):
+    """Embedding of every row projected against a fitted landmark model, bypassing the cache"""
+    _, _, df_norm = self._normalized(all_rows=True)
+    with metrics.stage('mds'):
+      embedding = self.engine.project(model, df_norm)
+    stress = kruskal_stress(df_norm, embedding, distances=self._current_distances(all_rows=True))
+    metrics.annotate(stress=round(stress, 4))
+    if self.campus_view:
+      self.embedding_all, self.stress_all = embedding, stress
+      return self._campus_view_embedding()
+    self.embedding, self.stress = embedding, stress
+    areas, _, _ = self._normalized()
+    return self._embedding_frame(areas, embedding)
+  
+  def _embedding_frame(self, areas, embedding):
+    """embedding_df: [0, 1]-scaled coordinates with the area columns of each bubble"""
+    embedding_df = self._scale(pd.DataFrame(embedding, columns=["x", "y"]))
+    areas = areas.reset_index(drop=True)
+    embedding_df["area_campus"] = areas["area_shortname"].astype(str) + "<br>(" + areas["campus"].astype(str) + ")"
+    for col in ["campus", 'area', 'area_shortname', 'category']:
+      embedding_df[col] = areas[col]
+    embedding_df["size"] = np.full(len(areas), self.bubble_size, dtype=np.uint8)
     
     return embedding_df
   
-  def update_from_table_data(self, table_data):
-    """Update embedding from edited table data"""
-    updated_df = pd.DataFrame(table_data)
-    self.df_current = updated_df.copy()
-    self.df_current_allcampus = self.df_current.copy()
-    self.embedding_df = self._compute_embedding(updated_df)
+  def export_frame(self):
+    """Current table with the columns of the loaded csv, in its order (uploaded score columns last)"""
+    df = self.df_current
+    columns = [col for col in self.original_columns if col in df.columns]
+    columns += [col for col in df.columns if col not in columns and col != 'category']
+    return df[columns]
+  
+  def export(self, fmt='csv'):
+    """Current table serialized by export_table, cached until data_version changes"""
+    cached = self._exports.get(fmt)
+    if cached is not None and cached[0] == self.data_version:
+      metrics.annotate(cache_hit=True)
+      return cached[1]
+    with metrics.stage('export'):
+      data = export_table(self.export_frame(), fmt)
+    self._exports[fmt] = (self.data_version, data)
+    return data
+  
+  def update_from_table_data(self, table_data, incremental=True):
+    """Update embedding from edited table data
+    
+    With `incremental`, SMACOF is seeded with the current coordinates when the
+    rows are unchanged so the layout stays stable across edits.
+    """
+    with metrics.stage('dataframe'):
+      updated_df = pd.DataFrame(table_data)
+      areas, scores, score_columns = self._split_frame(
+        updated_df, [col for col in self.score_columns if col in updated_df.columns])
+      init = None
+      if incremental and self.embedding is not None and len(areas) == len(self.embedding_df) \
+          and (areas[["campus", "area_shortname"]].astype(str).to_numpy()
+               == self.embedding_df[["campus", "area_shortname"]].astype(str).to_numpy()).all():
+        init = self.embedding
+      self._set_data(areas, scores, score_columns)
+    self.data_version += 1
+    self.embedding_df = self._compute_embedding(init=init)
 
     return self.embedding_df
   
-  def update_from_upload(self, uploaded_df):
-    """Update current dataframe from uploaded data"""
-    if isinstance(uploaded_df, pd.DataFrame):
-      uploaded_df = self._process_loaded_df(uploaded_df)
-      self.df_current = uploaded_df.copy()
-      self.df_current_allcampus = self.df_current.copy()
-      self.categories = sorted(self.df_current["category"].unique())
-    else:
-      print("Invalid upload data format. Expected a DataFrame.")
+  def table_page(self, page_current=0, page_size=50, sort_by=None, filter_query=''):
+    """One page of df_current for a custom-paged DataTable, as (records, page_count)
+    
+    Rows carry an `id` (their row position) so edits made on the page can be
+    sent back to `apply_edits` as cell deltas.
+    """
+    df = self.df_current
+    for filter_part in (filter_query or '').split(' && '):
+      column, operator, value, case = split_filter_part(filter_part)
+      if column not in df.columns:
+        continue
+      if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+        series = df[column]
+        if not pd.api.types.is_numeric_dtype(series):
+          # area columns are unordered categoricals: compare their text
+          series = series.astype(str)
+          value = value if isinstance(value, str) else f"{value:g}"
+          if not case:
+            series, value = series.str.lower(), value.lower()
+        try:
+          df = df.loc[getattr(series, operator)(value)]
+        except (TypeError, ValueError):
+          df = df.iloc[:0]  # e.g. text compared with a score column: nothing matches
+      elif operator == 'contains':
+        df = df.loc[df[column].astype(str).str.contains(value, case=case, regex=False)]
+      elif operator == 'datestartswith':
+        df = df.loc[df[column].astype(str).str.startswith(value)]
+    sort_by = [s for s in sort_by or [] if s['column_id'] in df.columns]
+    if sort_by:
+      # area columns are categoricals whose edited names are appended to the categories:
+      # sort them by their text, not by category code
+      df = df.sort_values([s['column_id'] for s in sort_by],
+                          ascending=[s['direction'] == 'asc' for s in sort_by], kind='stable',
+                          key=lambda col: col.astype(str) if isinstance(col.dtype, pd.CategoricalDtype) else col)
+    page_count = max(1, -(-len(df) // page_size))
+    page_current = min(page_current, page_count - 1)
+    page = df.iloc[page_current * page_size:(page_current + 1) * page_size]
+    records = page.drop(columns=self.editable_table_exclude_cols, errors='ignore').assign(id=page.index)
+    return records.to_dict('records'), page_count
+  
+  def _check_edits(self, changes):
+    """Validate cell edits with the rules of ingest.read_upload, raising EditError"""
+    errors, edited, invalid = [], {}, set()  # row -> its scores with the edits applied
+    for change in changes:
+      row, column, value = change['row'], change['column'], change['value']
+      if not 0 <= row < len(self.areas):
+        continue
+      if value is None or not str(value).strip():
+        if column in self.score_columns or column in AREA_COLUMNS:
+          errors.append({"column": column, "message": "value is empty"})
+          invalid.add(row)
+      elif column in self.score_columns:
+        number = pd.to_numeric(value, errors='coerce')
+        if pd.isna(number) or number < 0:
+          errors.append({"column": column, "message": not_a_score(value)})
+          invalid.add(row)
+          continue
+        if row not in edited:
+          edited[row] = self.scores[row].astype(np.float64)
+        edited[row][self.score_columns.index(column)] = number
+    for row, scores in edited.items():
+      if row not in invalid and np.nansum(scores) <= 0:
+        errors.append({"message": f"all scores of {self.areas['area_shortname'].iloc[row]} are zero"})
+    if errors:
+      raise EditError(errors[:MAX_ERRORS])
+  
+  def apply_edits(self, changes, incremental=True):
+    """Apply cell edits [{'row': row id, 'column': name, 'value': new value}] and re-embed
+    
+    Scores are written into the score matrix in place (upcasting it if a value
+    does not fit its dtype) and `category`, the normalized scores and distances
+    are recomputed for the touched rows only; the layout is warm-started from
+    the current coordinates since the rows do not change. Raises EditError,
+    leaving the table unchanged, if a score is not a non-negative number, an
+    area cell is empty or a row's scores would all be zero.
+    """
+    self._check_edits(changes)
+    self._unshare()
+    with metrics.stage('dataframe'):
+      rows = []
+      for change in changes:
+        row, column, value = change['row'], change['column'], change['value']
+        if not 0 <= row < len(self.areas):
+          continue
+        if column in self.score_columns:
+          value = pd.to_numeric(value)
+          dtype = compact_scores([[value]]).dtype
+          if not np.can_cast(dtype, self.scores.dtype):
+            self.scores = self.scores.astype(np.result_type(self.scores.dtype, dtype))
+          self.scores[row, self.score_columns.index(column)] = value
+        elif column in AREA_COLUMNS:
+          value = str(value)
+          if value not in self.areas[column].cat.categories:
+            self.areas[column] = self.areas[column].cat.add_categories([value])
+          self.areas.iloc[row, self.areas.columns.get_loc(column)] = value
+        else:
+          continue
+        rows.append(row)
+      if not rows:
+        return self.embedding_df
+      # rows whose campus changed may enter or leave the filtered view
+      view_changed = False
+      if self.campus != 'IUB/IUI' and any(change['column'] == 'campus' for change in changes):
+        current_rows = self._campus_rows(self.campus)
+        view_changed = not np.array_equal(current_rows, self.current_rows)
+        self.current_rows = current_rows
+      rows = np.unique(rows)
+      self.areas.iloc[rows, self.areas.columns.get_loc('category')] = \
+        np.asarray(self.score_columns)[self._argmax(self.scores[rows])]
+    with metrics.stage('normalize'):
+      self.scores_norm[rows] = self._normalize_scores(self.scores[np.ix_(rows, self._norm_index)])
+    with metrics.stage('distances'):
+      self._update_distances(rows)
+    self.data_version += 1
+    # the current coordinates only fit the view they were computed for (campus view
+    # mode warm-starts from the all-campus layout either way)
+    init = self.embedding if incremental and (self.campus_view or not view_changed) else None
+    self.embedding_df = self._compute_embedding(init=init)
+    return self.embedding_df
+  
+  def update_from_upload(self, uploaded_df, append=False):
+    """Update current dataframe from uploaded data, validated by ingest.read_upload
+    
+    With `append` the uploaded rows are added to the table (all campuses)
+    instead of replacing it. The landmark engine then keeps its landmarks:
+    every row is projected against them, so the existing bubbles stay put and
+    only the new rows are placed. Raises UploadError if appended rows have
+    other score columns.
+    """
+    if not isinstance(uploaded_df, pd.DataFrame):
+      raise TypeError(f"expected the uploaded table as a DataFrame, got {type(uploaded_df).__name__}")
+    model = None
+    with metrics.stage('dataframe'):
+      if append:
+        score_columns = [col for col in uploaded_df.columns if col not in AREA_COLUMNS]
+        if set(score_columns) != set(self.score_columns):
+          raise UploadError([{"message": "appended rows must have the score columns of the current table"}])
+        if hasattr(self.engine, 'project'):
+          model = self._landmark_model()
+        current = self._frame(self.areas, self.scores, self.score_columns).drop(columns='category')
+        uploaded_df = pd.concat([current, uploaded_df[current.columns]], ignore_index=True)
+      self._set_data(*self._process_loaded_df(uploaded_df))
+    self.data_version += 1
     
-    self.embedding_df = self._compute_embedding(uploaded_df)
+    self.embedding_df = self._compute_embedding() if model is None else self._project_embedding(model)
     return self.embedding_df
   
   def update_from_mds_seed(self, mds_seed=None):
     """Update embedding using a new MDS seed"""
     if mds_seed is None:
       mds_seed = random.randint(0, 10000)
-    self.embedding_df = self._compute_embedding(self.df_current, mds_seed)
+    self.embedding_df = self._compute_embedding(mds_seed=mds_seed)
     return self.embedding_df
   
+  def _campus_rows(self, campus):
+    # a view is just the selected row positions, nothing is copied
+    if campus == 'IUB/IUI':
+      return None
+    return np.flatnonzero(self.areas['campus'].isin(['IUB/IUI', campus]).to_numpy())
+  
   def update_from_dropdown(self, campus):
     """Filter current dataframe based on selected campus"""
-    if campus == 'IUB/IUI':
-      self.df_current = self.df_current_allcampus.copy()
+    with metrics.stage('dataframe'):
+      self.campus = campus
+      self.current_rows = self._campus_rows(campus)
+    self.data_version += 1
+    
+    if self.campus_view and self.embedding_all is not None:
+      # the all-campus layout is already computed, only select and rescale
+      self.embedding_df = self._campus_view_embedding()
+    else:
+      self.embedding_df = self._compute_embedding()
+    return self.embedding_df
+  
+  def bank_seeds(self, n_layouts):
+    """Current seed followed by n_layouts - 1 seeds derived from it, so banks are reproducible"""
+    rng = random.Random(self.mds_seed)
+    return [self.mds_seed] + [rng.randint(0, 10000) for _ in range(n_layouts - 1)]
+  
+  def _n_workers(self, n_workers=None):
+    """Worker processes for multi-seed runs; defaults to the engine's n_jobs, else all cores"""
+    if n_workers is None:
+      n_workers = getattr(self.engine, 'n_jobs', None)
+    if n_workers is None or n_workers < 1:
+      n_workers = os.cpu_count() or 1
+    return n_workers
+  
+  def _embed_seeds(self, df_norm, score_columns, seeds, n_workers=None):
+    """Raw embeddings of df_norm for each seed, through the embedding cache
+    
+    Missing seeds are computed in parallel: via the runner when it supports
+    map(), otherwise in a local process pool of `n_workers` processes.
+    """
+    keys = [self._embedding_key(df_norm, score_columns, seed) for seed in seeds]
+    embeddings = [self.embedding_cache.get(key) for key in keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+      logger.info("mds random seeds: %s (%s)", [seeds[i] for i in missing], self.engine.name)
+      args = ([df_norm] * len(missing), [seeds[i] for i in missing])
+      n_workers = min(self._n_workers(n_workers), len(missing))
+      with metrics.stage('normalize'):
+        distances = self._current_distances(all_rows=self.campus_view)
+      with metrics.stage('mds'):
+        if self.runner is None and n_workers > 1:
+          with shared_call(self.engine.embed, distances=distances) as embed, \
+              ProcessPoolExecutor(max_workers=n_workers, mp_context=process_context()) as pool:
+            computed = list(pool.map(embed, *args))
+        else:
+          computed = self._run_many(self.engine.embed, *args, distances=distances)
+      for i, embedding in zip(missing, computed):
+        self.embedding_cache.put(keys[i], embedding)
+        embeddings[i] = embedding
+    return embeddings
+  
+  def _view_slice(self, embedding):
+    """Current view's rows of an embedding of what _compute_embedding embeds"""
+    if self.campus_view and self.current_rows is not None:
+      return np.asarray(embedding)[self.current_rows]
+    return embedding
+  
+  def embedding_bank(self, n_layouts):
+    """Embed the current data with several seeds in one batch
+    
+    Returns (seeds, layouts) where layouts is a float32 array of shape
+    (n_layouts, rows, 2) scaled like embedding_df. Missing layouts are computed
+    in parallel; the raw embeddings are kept so update_from_bank can switch to
+    a banked seed without running MDS.
+    """
+    seeds = self.bank_seeds(n_layouts)
+    _, score_columns, df_norm = self._normalized(all_rows=self.campus_view)
+    embeddings = self._embed_seeds(df_norm, score_columns, seeds)
+    self._bank = (self.data_version, dict(zip(seeds, embeddings)))
+    layouts = np.stack([self._scale(np.asarray(self._view_slice(embedding))) for embedding in embeddings])
+    return seeds, layouts.astype(np.float32)
+  
+  def update_from_bank(self, seed):
+    """Show the banked layout of `seed` without running MDS; False if the seed is not banked for this data"""
+    if self._bank is None or self._bank[0] != self.data_version or seed not in self._bank[1]:
+      return False
+    self._adopt_embedding(seed, self._bank[1][seed])
+    return True
+  
+  def _adopt_embedding(self, seed, embedding):
+    """Show an already computed raw embedding (all campuses in campus view mode) for `seed`"""
+    self.mds_seed = seed
+    if self.campus_view:
+      _, _, df_norm = self._normalized(all_rows=True)
+      self.embedding_all = embedding
+      self.stress_all = kruskal_stress(df_norm, embedding, distances=self._current_distances(all_rows=True))
+      self.embedding_df = self._campus_view_embedding()
     else:
-      self.df_current = self.df_current_allcampus[self.df_current_allcampus['campus'].isin(['IUB/IUI', campus])].copy()
+      areas, _, df_norm = self._normalized()
+      self.embedding = embedding
+      self.stress = kruskal_stress(df_norm, embedding, distances=self._current_distances())
+      self.embedding_df = self._embedding_frame(areas, embedding)
+    return self.embedding_df
+  
+  @staticmethod
+  def separation(embedding):
+    """Mean nearest-neighbour distance of the [0, 1]-scaled layout; higher means less bubble overlap"""
+    points = DataProcessor._scale(np.asarray(embedding))
+    if len(points) < 2:
+      return 0.0
+    from scipy.spatial import cKDTree
+    distances, _ = cKDTree(points).query(points, k=2)
+    return float(distances[:, 1].mean())
+  
+  def seed_layouts(self, seeds=None, n_seeds=8, n_workers=None):
+    """Embed the current data with several seeds in parallel
+    
+    Seeds default to `n_seeds` random ones. Returns one dict per seed with its
+    raw embedding of the view, Kruskal stress and separation, in the order of
+    `seeds`; in campus view mode `embedding_all` holds the all-campus one.
+    """
+    if seeds is None:
+      seeds = [random.randint(0, 10000) for _ in range(n_seeds)]
+    _, _, df_norm = self._normalized()
+    distances = self._current_distances()
+    _, score_columns, df_embed = self._normalized(all_rows=self.campus_view)
+    layouts = []
+    for seed, raw in zip(seeds, self._embed_seeds(df_embed, score_columns, list(seeds), n_workers)):
+      embedding = self._view_slice(raw)
+      layouts.append({"seed": seed, "embedding": embedding,
+                      "stress": kruskal_stress(df_norm, embedding, distances=distances),
+                      "separation": self.separation(embedding)})
+      if self.campus_view:
+        layouts[-1]["embedding_all"] = raw
+    return layouts
+  
+  @staticmethod
+  def pick_layout(layouts, criterion='stress'):
+    """Lowest-stress layout, or the best separated one with criterion='separation'"""
+    if criterion == 'stress':
+      return min(layouts, key=lambda layout: layout["stress"])
+    if criterion == 'separation':
+      return max(layouts, key=lambda layout: layout["separation"])
+    raise ValueError(f"criterion must be 'stress' or 'separation', got {criterion!r}")
+  
+  def update_from_best_seed(self, seeds=None, n_seeds=8, criterion='stress', n_workers=None):
+    """Update embedding using the best of several seeds, computed in parallel"""
+    best = self.pick_layout(self.seed_layouts(seeds, n_seeds, n_workers), criterion)
+    # shown as computed: the cache may be smaller than the batch or have evicted it
+    return self._adopt_embedding(best["seed"], best.get("embedding_all", best["embedding"]))
+  
+  def engine_report(self, engines=None, stress_target=None):
+    """Stress and runtime of each embedding engine on the current data
     
-    self.embedding_df = self._compute_embedding(self.df_current)
-    return self.embedding_df
\ No newline at end of file
+    Runs bypass the embedding cache so timings are comparable. If `stress_target`
+    is given, `meets_target` flags engines whose stress is at or below it; the
+    cheapest of those is the first such row.
+    """
+    _, _, df_norm = self._normalized()
+    # the maintained matrix, if any, as the app's runs get it; engines compute their own otherwise
+    distances = self._current_distances()
+    rows = []
+    for name in (sorted(ENGINES) if engines is None else engines):
+      engine = get_engine(name)
+      start = time.perf_counter()
+      embedding = engine.embed(df_norm, seed=self.mds_seed, distances=distances if engine.uses_distances else None)
+      seconds = time.perf_counter() - start
+      rows.append({"engine": engine.name, "stress": kruskal_stress(df_norm, embedding, distances=distances),
+                   "seconds": seconds})
+    report = pd.DataFrame(rows).sort_values("seconds", ignore_index=True)
+    if stress_target is not None:
+      report["meets_target"] = report["stress"] <= stress_target
+    return report
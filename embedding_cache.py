@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def file_checksum(path):
+  """sha256 of a file's bytes, used to tie precomputed embeddings to their input CSV"""
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class EmbeddingCache:
+  """Bounded LRU cache of 2-d embeddings keyed by a content hash of their inputs"""
+
+  def __init__(self, maxsize=128):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def make_key(scores, columns, seed, params):
+    """Hash normalized score matrix, category column order, seed and embedding parameters"""
+    scores = np.ascontiguousarray(scores, dtype=np.float64)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(scores.shape).encode())
+    h.update(scores.tobytes())
+    h.update("\x1f".join(map(str, columns)).encode())
+    h.update(repr(seed).encode())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+  def get(self, key):
+    with self._lock:
+      embedding = self._entries.get(key)
+      if embedding is None:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return embedding
+
+  def put(self, key, embedding):
+    if self.maxsize <= 0:
+      return
+    embedding = np.array(embedding, dtype=np.float64)
+    embedding.setflags(write=False)
+    with self._lock:
+      self._entries[key] = embedding
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def resize(self, maxsize):
+    """Change capacity, evicting least recently used entries if needed"""
+    with self._lock:
+      self.maxsize = maxsize
+      while len(self._entries) > max(maxsize, 0):
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.hits = self.misses = self.evictions = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def save(self, path, checksum):
+    """Write all entries to an .npz artifact tagged with the input `checksum`"""
+    with self._lock:
+      arrays = {f"emb_{key}": embedding for key, embedding in self._entries.items()}
+    np.savez_compressed(path, checksum=np.array(checksum), **arrays)
+
+  def load(self, path, checksum):
+    """Add entries from an .npz artifact if its checksum matches; returns the number loaded"""
+    path = Path(path)
+    if not path.exists():
+      return 0
+    with np.load(path) as artifact:
+      if str(artifact["checksum"]) != checksum:
+        logger.warning("ignoring stale precomputed embeddings %s", path)
+        return 0
+      names = [name for name in artifact.files if name.startswith("emb_")]
+      for name in names:
+        self.put(name[len("emb_"):], artifact[name])
+    return len(names)
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      "size": len(self._entries),
+      "maxsize": self.maxsize,
+      "hits": self.hits,
+      "misses": self.misses,
+      "evictions": self.evictions,
+      "hit_rate": self.hits / lookups if lookups else 0.0,
+    }
+
+
+# shared across DataProcessor instances unless one is passed explicitly
+default_cache = EmbeddingCache(maxsize=int(os.environ.get("EMBEDDING_CACHE_SIZE", 128)))
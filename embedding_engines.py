@@ -0,0 +1,226 @@
+import os
+
+import numpy as np
+
+# sklearn is imported by SmacofEngine on first use, it is the slowest import of the app
+
+
+def euclidean_distances(X, Y=None):
+  """Euclidean distance matrix, as sklearn.metrics.euclidean_distances computes it"""
+  X = np.asarray(X, dtype=np.float64)
+  Y = X if Y is None else np.asarray(Y, dtype=np.float64)
+  xx = np.einsum('ij,ij->i', X, X)
+  yy = xx if Y is X else np.einsum('ij,ij->i', Y, Y)
+  d2 = -2 * (X @ Y.T)
+  d2 += xx[:, None]
+  d2 += yy[None, :]
+  np.maximum(d2, 0, out=d2)
+  if Y is X:
+    np.fill_diagonal(d2, 0)
+  return np.sqrt(d2, out=d2)
+
+
+def pairwise_distances(X, Y=None, dtype=np.float32):
+  """Euclidean distances between the rows of X (and Y), float32 by default to halve their memory"""
+  Y = None if Y is None else np.asarray(Y, dtype=np.float64)
+  return euclidean_distances(np.asarray(X, dtype=np.float64), Y).astype(dtype, copy=False)
+
+
+def kruskal_stress(X, embedding, max_points=2000, distances=None):
+  """Kruskal stress-1 of an embedding against the euclidean distances of X
+  
+  Above `max_points` rows it is estimated on a fixed random subset of rows,
+  keeping the cost bounded instead of O(n^2) in memory. `distances` is the
+  precomputed distance matrix of X, if available.
+  """
+  X = np.asarray(X, dtype=np.float64)
+  embedding = np.asarray(embedding, dtype=np.float64)
+  rows = None
+  if len(X) > max_points:
+    rows = np.random.default_rng(0).choice(len(X), max_points, replace=False)
+    X, embedding = X[rows], embedding[rows]
+  if distances is None:
+    d_high = euclidean_distances(X)
+  else:
+    d_high = np.asarray(distances if rows is None else distances[np.ix_(rows, rows)], dtype=np.float64)
+  d_low = euclidean_distances(embedding)
+  denom = np.square(d_high).sum()
+  return float(np.sqrt(np.square(d_high - d_low).sum() / denom)) if denom > 0 else 0.0
+
+
+def _fix_signs(embedding):
+  """Make eigen/SVD based embeddings deterministic by orienting each axis"""
+  idx = np.abs(embedding).argmax(axis=0)
+  signs = np.sign(embedding[idx, np.arange(embedding.shape[1])])
+  signs[signs == 0] = 1
+  return embedding * signs
+
+
+class EmbeddingEngine:
+  """Maps a row-normalized score matrix to 2-d coordinates
+  
+  Engines with `uses_distances` work on the pairwise distance matrix and
+  accept it precomputed via `embed(X, seed, distances=...)`.
+  """
+  name = None
+  supports_warm_start = False
+  uses_distances = False
+
+  def __init__(self, n_components=2):
+    self.n_components = n_components
+
+  def params(self):
+    """Parameters that change the output, used in embedding cache keys"""
+    return {"engine": self.name, "n_components": self.n_components}
+
+  def embed(self, X, seed=None, distances=None):
+    raise NotImplementedError
+
+
+def _precomputed_mds(**params):
+  """sklearn MDS on a distance matrix: `metric="precomputed"` since scikit-learn 1.8, `dissimilarity` before"""
+  from sklearn.manifold import MDS
+  keyword = "metric" if "metric_mds" in MDS().get_params() else "dissimilarity"
+  return MDS(**params, **{keyword: "precomputed"})
+
+
+class SmacofEngine(EmbeddingEngine):
+  """Iterative metric MDS (sklearn SMACOF) with random restarts"""
+  name = "smacof"
+  supports_warm_start = True
+  uses_distances = True
+
+  def __init__(self, n_components=2, n_init=4, max_iter=300, eps=1e-6, n_jobs=None):
+    super().__init__(n_components)
+    self.n_init = n_init
+    self.max_iter = max_iter
+    self.eps = eps
+    self.n_jobs = n_jobs
+
+  def params(self):
+    return {**super().params(), "n_init": self.n_init, "max_iter": self.max_iter, "eps": self.eps}
+
+  def embed(self, X, seed=None, distances=None):
+    from sklearn.manifold import MDS
+    if distances is not None:
+      return _precomputed_mds(n_components=self.n_components, n_init=self.n_init, max_iter=self.max_iter, eps=self.eps,
+                              n_jobs=self.n_jobs, random_state=seed).fit_transform(distances)
+    return MDS(n_components=self.n_components, n_init=self.n_init, max_iter=self.max_iter,
+               eps=self.eps, n_jobs=self.n_jobs, random_state=seed).fit_transform(X)
+
+  def refine(self, X, init, seed=None, max_iter=100, eps=1e-3, distances=None):
+    """Single SMACOF run started from `init` coordinates"""
+    from sklearn.manifold import MDS
+    if distances is not None:
+      return _precomputed_mds(n_components=self.n_components, n_init=1, max_iter=max_iter, eps=eps,
+                              random_state=seed).fit_transform(distances, init=init)
+    return MDS(n_components=self.n_components, n_init=1, max_iter=max_iter, eps=eps,
+               random_state=seed).fit_transform(X, init=init)
+
+
+class ClassicalMDSEngine(EmbeddingEngine):
+  """Closed-form Torgerson MDS: top eigenvectors of the double-centered squared distances"""
+  name = "classical"
+  uses_distances = True
+
+  def embed(self, X, seed=None, distances=None):
+    if distances is None:
+      distances = euclidean_distances(np.asarray(X, dtype=np.float64))
+    d2 = np.square(np.asarray(distances, dtype=np.float64))
+    b = -0.5 * (d2 - d2.mean(axis=0) - d2.mean(axis=1)[:, None] + d2.mean())
+    eigvals, eigvecs = np.linalg.eigh(b)
+    order = np.argsort(eigvals)[::-1][:self.n_components]
+    eigvals = np.clip(eigvals[order], 0, None)
+    return _fix_signs(eigvecs[:, order] * np.sqrt(eigvals))
+
+
+class PCAEngine(EmbeddingEngine):
+  """Projection on the leading principal axes; O(n) in the number of areas"""
+  name = "pca"
+
+  def embed(self, X, seed=None, distances=None):
+    X = np.asarray(X, dtype=np.float64)
+    X = X - X.mean(axis=0)
+    _, _, vt = np.linalg.svd(X, full_matrices=False)
+    return _fix_signs(X @ vt[:self.n_components].T)
+
+
+class LandmarkMDSEngine(EmbeddingEngine):
+  """Landmark MDS (de Silva & Tenenbaum): classical MDS on `n_landmarks` rows, the rest triangulated
+
+  Landmarks are picked by max-min distance from a seeded random start and
+  embedded exactly; every row is then placed from its squared distances to the
+  landmarks in one vectorized projection, so time and memory are
+  O(n * n_landmarks). `fit` and `project` are exposed separately so rows added
+  later can be placed without re-embedding. n_landmarks defaults to
+  $LANDMARK_COUNT, else 200.
+  """
+  name = "landmark"
+
+  def __init__(self, n_components=2, n_landmarks=None, block_rows=10000):
+    super().__init__(n_components)
+    self.n_landmarks = int(os.environ.get("LANDMARK_COUNT", 200)) if n_landmarks is None else n_landmarks
+    self.block_rows = block_rows
+
+  def params(self):
+    return {**super().params(), "n_landmarks": self.n_landmarks}
+
+  @staticmethod
+  def select_landmarks(X, n_landmarks, seed=None):
+    """Indices of up to n_landmarks distinct rows spread out by greedy max-min distance"""
+    first = int(np.random.default_rng(seed).integers(len(X)))
+    chosen = [first]
+    nearest = np.linalg.norm(X - X[first], axis=1)
+    for _ in range(n_landmarks - 1):
+      i = int(nearest.argmax())
+      if nearest[i] == 0:  # every distinct row is already a landmark
+        break
+      chosen.append(i)
+      nearest = np.minimum(nearest, np.linalg.norm(X - X[i], axis=1))
+    return np.array(chosen)
+
+  def fit(self, X, seed=None):
+    """Landmark model (landmark rows, their mean squared distances, projection matrix)"""
+    X = np.asarray(X, dtype=np.float64)
+    landmarks = X[self.select_landmarks(X, min(self.n_landmarks, len(X)), seed)]
+    d2 = np.square(euclidean_distances(landmarks))
+    mean_d2 = d2.mean(axis=0)
+    b = -0.5 * (d2 - mean_d2 - d2.mean(axis=1)[:, None] + d2.mean())
+    eigvals, eigvecs = np.linalg.eigh(b)
+    order = np.argsort(eigvals)[::-1][:self.n_components]
+    eigvals, eigvecs = eigvals[order], eigvecs[:, order]
+    positive = eigvals > 1e-12
+    # transposed pseudo-inverse of the landmark coordinates eigvecs * sqrt(eigvals)
+    projection = np.zeros_like(eigvecs)
+    projection[:, positive] = eigvecs[:, positive] / np.sqrt(eigvals[positive])
+    # orient axes like _fix_signs does for the landmark coordinates
+    signs = np.sign(_fix_signs(eigvecs * np.sqrt(np.clip(eigvals, 0, None)))[0] * eigvecs[0])
+    signs[signs == 0] = 1
+    return landmarks, mean_d2, projection * signs
+
+  def project(self, model, X):
+    """Coordinates of rows of X triangulated from their distances to the landmarks"""
+    landmarks, mean_d2, projection = model
+    X = np.asarray(X, dtype=np.float64)
+    embedding = np.empty((len(X), projection.shape[1]))
+    for start in range(0, len(X), self.block_rows):
+      d2 = np.square(euclidean_distances(X[start:start + self.block_rows], landmarks))
+      embedding[start:start + self.block_rows] = -0.5 * (d2 - mean_d2) @ projection
+    return embedding
+
+  def embed(self, X, seed=None, distances=None):
+    return self.project(self.fit(X, seed), X)
+
+
+ENGINES = {engine.name: engine for engine in (SmacofEngine, ClassicalMDSEngine, PCAEngine, LandmarkMDSEngine)}
+DEFAULT_ENGINE = os.environ.get("EMBEDDING_ENGINE", SmacofEngine.name)
+
+
+def get_engine(engine=None, **kwargs):
+  """Resolve an engine instance from an instance, a registered name or EMBEDDING_ENGINE"""
+  if isinstance(engine, EmbeddingEngine):
+    return engine
+  name = DEFAULT_ENGINE if engine is None else engine
+  if name not in ENGINES:
+    raise ValueError(f"unknown embedding engine {name!r}, expected one of {sorted(ENGINES)}")
+  return ENGINES[name](**kwargs)
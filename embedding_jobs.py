@@ -0,0 +1,202 @@
+import functools
+import multiprocessing
+import os
+import sys
+import threading
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+class JobSuperseded(Exception):
+  """Raised when a newer job was claimed for the same key"""
+
+
+SHARE_MIN_BYTES = 1 << 20  # array arguments from this size go to worker processes in shared memory
+
+
+def _attach(name):
+  # Python >= 3.13 can attach without registering the segment with the resource tracker
+  return SharedMemory(name) if sys.version_info < (3, 13) else SharedMemory(name, track=False)
+
+
+class SharedCall:
+  """Picklable fn(*args, **kwargs, **arrays) whose `arrays` are read from shared memory in the worker"""
+
+  def __init__(self, fn, kwargs, shared):
+    self.fn = fn
+    self.kwargs = kwargs
+    self.shared = shared  # keyword -> (segment name, shape, dtype)
+
+  def __call__(self, *args):
+    segments = [_attach(name) for name, _, _ in self.shared.values()]
+    arrays = {}
+    try:
+      for segment, (key, (_, shape, dtype)) in zip(segments, self.shared.items()):
+        arrays[key] = np.ndarray(shape, dtype, buffer=segment.buf)
+      return self.fn(*args, **self.kwargs, **arrays)
+    finally:
+      arrays.clear()  # drop the views before closing the segments under them
+      for segment in segments:
+        segment.close()
+
+
+@contextmanager
+def shared_call(fn, min_bytes=SHARE_MIN_BYTES, **kwargs):
+  """functools.partial(fn, **kwargs) for worker processes, with large arrays in shared memory
+
+  Array keyword arguments of at least `min_bytes` (e.g. a distance matrix) are
+  copied once into shared memory instead of being pickled with every call.
+  The segments are unlinked when the block exits; a worker still attached
+  keeps its mapping, only the name goes away.
+  """
+  segments, shared, small = [], {}, {}
+  try:
+    for key, value in kwargs.items():
+      if isinstance(value, np.ndarray) and value.nbytes >= min_bytes and value.nbytes:
+        segment = SharedMemory(create=True, size=value.nbytes)
+        segments.append(segment)
+        np.ndarray(value.shape, value.dtype, buffer=segment.buf)[...] = value
+        shared[key] = (segment.name, value.shape, value.dtype.str)
+      else:
+        small[key] = value
+    yield SharedCall(fn, small, shared) if shared else functools.partial(fn, **small)
+  finally:
+    for segment in segments:
+      segment.close()
+      segment.unlink()
+
+
+def process_context():
+  """Start method for worker pools: forkserver, else spawn; never fork a threaded server process"""
+  method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+  return multiprocessing.get_context(method)
+
+
+class EmbeddingJobManager:
+  """Runs embedding computations off the request thread, at most `max_workers` at a time
+  
+  Jobs are grouped by key (session and callback). `claim(key)` starts a new
+  generation for the key and cancels its queued job; a job whose generation was
+  superseded raises JobSuperseded as soon as it is superseded, without waiting
+  for a job already running in a worker, whose result is then dropped.
+  With the process executor, array keyword arguments of at least
+  `share_min_bytes` (e.g. a distance matrix) are copied once into shared
+  memory instead of being pickled to the worker.
+  """
+
+  def __init__(self, max_workers=2, executor="process", share_min_bytes=SHARE_MIN_BYTES):
+    if executor not in ("process", "thread"):
+      raise ValueError(f"executor must be 'process' or 'thread', got {executor!r}")
+    self.max_workers = max_workers
+    self.executor = executor
+    self._pool = None
+    self._pool_pid = None
+    self._generations = {}
+    self._futures = {}  # key -> (futures, wake event) of the key's current job
+    self.share_min_bytes = share_min_bytes
+    self._lock = threading.Lock()
+
+  def _get_pool(self):
+    # created lazily, and again after a fork, so worker processes never share a pool
+    if self._pool is None or self._pool_pid != os.getpid():
+      if self.executor == "process":
+        # forking a gthread worker while other request threads hold locks can deadlock the child
+        self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=process_context())
+      else:
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+      self._pool_pid = os.getpid()
+    return self._pool
+
+  def claim(self, key):
+    """Start a new generation for `key`, superseding any earlier job"""
+    with self._lock:
+      generation = self._generations.get(key, 0) + 1
+      self._generations[key] = generation
+      futures, wake = self._futures.pop(key, ([], None))
+    for future in futures:
+      future.cancel()
+    if wake is not None:
+      wake.set()  # the superseded caller stops waiting for its running job
+    return key, generation
+
+  def check(self, token):
+    key, generation = token
+    if self._generations.get(key) != generation:
+      raise JobSuperseded(key)
+
+  def _wait(self, token, fn, arg_lists, kwargs):
+    self.check(token)
+    futures = None
+    if self.executor == "process":
+      bound = shared_call(fn, self.share_min_bytes, **kwargs)
+    else:
+      bound = nullcontext(functools.partial(fn, **kwargs))
+    with bound as call:
+      wake = threading.Event()  # set when a future finishes or the job is superseded
+      try:
+        with self._lock:
+          pool = self._get_pool()
+          futures = [pool.submit(call, *args) for args in arg_lists]
+          self._futures[token[0]] = (futures, wake)
+        for future in futures:
+          future.add_done_callback(lambda _: wake.set())
+        while not all(future.done() for future in futures):
+          wake.wait()
+          wake.clear()
+          self.check(token)
+        results = [future.result() for future in futures]
+      except CancelledError:
+        raise JobSuperseded(token[0])
+      finally:
+        with self._lock:
+          if futures is not None and self._futures.get(token[0], (None,))[0] is futures:
+            del self._futures[token[0]]
+    self.check(token)
+    return results
+
+  def run(self, token, fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) in the pool and wait for it, unless superseded"""
+    return self._wait(token, fn, [args], kwargs)[0]
+
+  def map(self, token, fn, *iterables, **kwargs):
+    """Run fn over the zipped iterables in parallel, with `kwargs` for every call, and wait for all results"""
+    return self._wait(token, fn, list(zip(*iterables)), kwargs)
+
+  def runner(self, token):
+    """Runner for DataProcessor.runner bound to `token`"""
+    return JobRunner(self, token)
+
+  def release(self, token):
+    """Forget `token`'s key once its job is done, unless it was claimed again"""
+    key, generation = token
+    with self._lock:
+      if self._generations.get(key) == generation:
+        del self._generations[key]
+
+  def shutdown(self):
+    if self._pool is not None:
+      self._pool.shutdown(wait=False, cancel_futures=True)
+      self._pool = None
+
+
+class JobRunner:
+  """Callable running single jobs, with map() for batches, under one job token"""
+
+  def __init__(self, manager, token):
+    self.manager = manager
+    self.token = token
+
+  def __call__(self, fn, *args, **kwargs):
+    return self.manager.run(self.token, fn, *args, **kwargs)
+
+  def map(self, fn, *iterables, **kwargs):
+    return self.manager.map(self.token, fn, *iterables, **kwargs)
+
+
+jobs = EmbeddingJobManager(
+  max_workers=int(os.environ.get("MDS_MAX_JOBS", 2)),
+  executor=os.environ.get("MDS_EXECUTOR", "process"),
+)
@@ -0,0 +1,36 @@
+import gc
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# load the app (csvs, embeddings, default layout) once in the master and fork workers from it
+preload_app = True
+bind = f"0.0.0.0:{os.environ.get('PORT', 8050)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", min(multiprocessing.cpu_count(), 4)))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))  # MDS on a large upload can take a while
+keepalive = 5
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+# sessions must be visible to every worker: without a configured directory they are
+# kept in a temporary one shared by this server's workers and removed by on_exit. A session's distance matrix
+# and export cache are not pickled, they stay in the memory of the worker that built them
+# (see SESSION_CACHE_SIZE in dash_app.py) and are rebuilt when another worker serves it
+_session_dir = None
+if workers > 1 and not os.environ.get("SESSION_STORE_DIR"):
+  _session_dir = tempfile.mkdtemp(prefix="luddy-sessions-")
+  os.environ["SESSION_STORE_DIR"] = _session_dir
+
+
+def when_ready(server):
+  # objects loaded by the master are never freed; keep the collector from
+  # touching (and so copying) their pages in every worker
+  gc.freeze()
+
+
+def on_exit(server):
+  if _session_dir is not None:
+    shutil.rmtree(_session_dir, ignore_errors=True)
@@ -0,0 +1,127 @@
+import base64
+import binascii
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+AREA_COLUMNS = ["campus", "area_shortname", "area"]
+MAX_UPLOAD_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 5 * 1024 * 1024))
+MAX_UPLOAD_ROWS = int(os.environ.get("UPLOAD_MAX_ROWS", 50000))
+CHUNK_ROWS = 10000
+MAX_ERRORS = 20  # validation stops collecting after this many problems
+
+
+class UploadError(ValueError):
+  """Upload rejected by validation; `errors` holds {'row', 'column', 'message'} dicts"""
+
+  def __init__(self, errors):
+    self.errors = errors
+    super().__init__("; ".join(format_error(error) for error in errors))
+
+
+class EditError(UploadError):
+  """Table edit rejected by validation; `errors` as for UploadError"""
+
+
+def not_a_score(value):
+  """Error message for a score cell that is not a non-negative number"""
+  return f"'{value!s}' is not a non-negative number"
+
+
+def format_error(error):
+  where = [f"row {error['row']}" if error.get("row") is not None else None,
+           f"column {error['column']!r}" if error.get("column") is not None else None]
+  where = ", ".join(w for w in where if w)
+  return f"{where}: {error['message']}" if where else error["message"]
+
+
+def decode_contents(contents, max_bytes=MAX_UPLOAD_BYTES):
+  """Bytes of a dcc.Upload data URL, refusing oversized files before decoding them"""
+  _, _, data = contents.partition(",")
+  size = len(data) * 3 // 4 - data.count("=", -2)
+  if size > max_bytes:
+    raise UploadError([{"message": f"file is {size / 2 ** 20:.1f} MiB, the limit is {max_bytes / 2 ** 20:.1f} MiB"}])
+  try:
+    return base64.b64decode(data, validate=True)
+  except (binascii.Error, ValueError):
+    raise UploadError([{"message": "file is not valid base64 data"}])
+
+
+def _check_columns(columns):
+  missing = [col for col in AREA_COLUMNS if col not in columns]
+  errors = [{"column": col, "message": "required column is missing"} for col in missing]
+  if len(columns) - len(AREA_COLUMNS) + len(missing) < 1:
+    errors.append({"message": "no score columns, expected one numeric column per category"})
+  return errors
+
+
+def _validate_chunk(chunk, score_columns, first_row, errors):
+  """Apply the schema to one chunk in place: categorical area columns, compact numeric scores"""
+  for col in AREA_COLUMNS:
+    blank = chunk[col].isna()
+    for row in np.flatnonzero(blank.to_numpy())[:MAX_ERRORS - len(errors)]:
+      errors.append({"row": first_row + int(row), "column": col, "message": "value is empty"})
+    chunk[col] = chunk[col].astype("category")
+  invalid = np.zeros(len(chunk), dtype=bool)
+  for col in score_columns:
+    values = pd.to_numeric(chunk[col], errors="coerce")
+    bad = values.isna() | (values < 0)
+    invalid |= bad.to_numpy()
+    for row in np.flatnonzero(bad.to_numpy())[:MAX_ERRORS - len(errors)]:
+      errors.append({"row": first_row + int(row), "column": col,
+                     "message": not_a_score(chunk[col].iloc[row])})
+    chunk[col] = pd.to_numeric(values, downcast="unsigned") if not bad.any() else values
+  scores = chunk[score_columns].to_numpy(dtype=np.float64, na_value=0)
+  # a row with an invalid score is already reported, its sum means nothing
+  for row in np.flatnonzero((scores.sum(axis=1) <= 0) & ~invalid)[:MAX_ERRORS - len(errors)]:
+    errors.append({"row": first_row + int(row), "message": "all scores are zero"})
+  return chunk
+
+
+def _read_chunks(buffer, filename, chunk_rows):
+  if filename.lower().endswith((".xls", ".xlsx")):
+    yield pd.read_excel(buffer)
+  else:
+    yield from pd.read_csv(buffer, chunksize=chunk_rows, encoding="utf-8-sig", dtype={col: str for col in AREA_COLUMNS})
+
+
+def read_upload(contents, filename, max_bytes=MAX_UPLOAD_BYTES, max_rows=MAX_UPLOAD_ROWS, chunk_rows=CHUNK_ROWS):
+  """Parse and validate an uploaded score table (CSV or Excel) from a dcc.Upload data URL
+
+  The file is parsed from its decoded bytes in chunks of `chunk_rows` rows;
+  each chunk gets categorical area columns and compact numeric score columns.
+  Raises UploadError listing the problems if the file is too large, has too
+  many rows, lacks the campus/area_shortname/area columns or has scores that
+  are not non-negative numbers.
+  """
+  filename = filename or ""
+  if not filename.lower().endswith((".csv", ".xls", ".xlsx")):
+    raise UploadError([{"message": f"unsupported file type {filename!r}, expected .csv, .xls or .xlsx"}])
+  buffer = io.BytesIO(decode_contents(contents, max_bytes))
+  chunks, errors, n_rows = [], [], 0
+  try:
+    for chunk in _read_chunks(buffer, filename, chunk_rows):
+      if not chunks:
+        errors += _check_columns(list(chunk.columns))
+        if errors:
+          break
+        score_columns = [col for col in chunk.columns if col not in AREA_COLUMNS]
+      if n_rows + len(chunk) > max_rows:
+        errors.append({"message": f"more than {max_rows} rows"})
+        break
+      chunks.append(_validate_chunk(chunk, score_columns, n_rows + 1, errors))
+      n_rows += len(chunk)
+      if len(errors) >= MAX_ERRORS:
+        break
+  except (ValueError, ImportError, UnicodeDecodeError, pd.errors.ParserError) as e:
+    errors.append({"message": f"could not parse the file: {e}"})
+  if not errors and not n_rows:
+    errors.append({"message": "the table has no rows"})
+  if errors:
+    raise UploadError(errors[:MAX_ERRORS])
+  df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+  for col in AREA_COLUMNS:
+    df[col] = df[col].astype("category")  # categories of concatenated chunks may differ
+  return df
@@ -0,0 +1,145 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metrics:
+  """Per-stage timings of Dash callbacks, exported in Prometheus text format
+
+  `instrument(name)` wraps a callback in a trace; `stage(name)` times a block
+  inside the current trace (DataProcessor calls it for normalization and MDS).
+  After the response is built `finish_request(nbytes)` adds the serialization
+  time and payload size and, with a log path, writes the trace as a JSON line.
+  Counters live in process memory: under gunicorn every worker keeps its own,
+  and a scrape of /metrics reports the worker that answered it (its pid is the
+  `worker` label of the worker_info gauge).
+  """
+
+  def __init__(self, prefix="luddy", log_path=None):
+    self.prefix = prefix
+    self.log_path = log_path
+    self._stage_count = defaultdict(int)
+    self._stage_sum = defaultdict(float)
+    self._stage_max = defaultdict(float)
+    self._bytes_count = defaultdict(int)
+    self._bytes_sum = defaultdict(int)
+    self._gauges = {}
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  def _current(self):
+    return getattr(self._local, "trace", None)
+
+  def _record(self, callback, stage, seconds):
+    key = (callback, stage)
+    with self._lock:
+      self._stage_count[key] += 1
+      self._stage_sum[key] += seconds
+      self._stage_max[key] = max(self._stage_max[key], seconds)
+
+  @contextmanager
+  def stage(self, name):
+    trace = self._current()
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      seconds = time.perf_counter() - start
+      self._record(trace["callback"] if trace else "", name, seconds)
+      if trace is not None:
+        trace["stages"][name] = trace["stages"].get(name, 0.0) + seconds
+
+  def annotate(self, **fields):
+    """Attach extra fields (e.g. cache_hit=True) to the current trace's log line"""
+    trace = self._current()
+    if trace is not None:
+      trace.update(fields)
+
+  def instrument(self, name):
+    """Decorator starting a trace named `name` around a callback"""
+    def decorator(fn):
+      @functools.wraps(fn)
+      def wrapper(*args, **kwargs):
+        self._local.trace = trace = {"callback": name, "stages": {}}
+        start = time.perf_counter()
+        try:
+          return fn(*args, **kwargs)
+        finally:
+          trace["end"] = time.perf_counter()
+          trace["stages"]["callback"] = trace["end"] - start
+          self._record(name, "callback", trace["stages"]["callback"])
+      return wrapper
+    return decorator
+
+  def finish_request(self, nbytes):
+    """Close the current trace once its response of `nbytes` bytes is serialized"""
+    trace = self._current()
+    self._local.trace = None
+    if trace is None or "end" not in trace:
+      return
+    callback = trace["callback"]
+    serialize = time.perf_counter() - trace.pop("end")
+    trace["stages"]["serialize"] = serialize
+    self._record(callback, "serialize", serialize)
+    with self._lock:
+      self._bytes_count[callback] += 1
+      self._bytes_sum[callback] += nbytes
+    if self.log_path:
+      self._log({"ts": time.time(), **trace, "response_bytes": nbytes})
+
+  def _log(self, record):
+    line = json.dumps(record, default=str) + "\n"
+    if self.log_path in ("-", "stdout"):
+      sys.stdout.write(line)
+    elif self.log_path == "stderr":
+      sys.stderr.write(line)
+    else:
+      with self._lock, open(self.log_path, "a") as f:
+        f.write(line)
+
+  def gauge(self, name, help_text, fn):
+    """Register a gauge read at scrape time; fn() returns a number or {labels tuple: number}"""
+    self._gauges[name] = (help_text, fn)
+
+  def render(self):
+    """Prometheus text exposition of all stage timings, payload sizes and gauges"""
+    p = self.prefix
+    lines = [
+      f"# HELP {p}_stage_seconds Time spent per callback stage.",
+      f"# TYPE {p}_stage_seconds summary",
+    ]
+    with self._lock:
+      for (callback, stage), count in sorted(self._stage_count.items()):
+        labels = f'callback="{callback}",stage="{stage}"'
+        lines.append(f"{p}_stage_seconds_count{{{labels}}} {count}")
+        lines.append(f"{p}_stage_seconds_sum{{{labels}}} {self._stage_sum[(callback, stage)]:.6f}")
+      lines += [f"# HELP {p}_stage_seconds_max Slowest observation per callback stage.",
+                f"# TYPE {p}_stage_seconds_max gauge"]
+      for (callback, stage), seconds in sorted(self._stage_max.items()):
+        lines.append(f'{p}_stage_seconds_max{{callback="{callback}",stage="{stage}"}} {seconds:.6f}')
+      lines += [f"# HELP {p}_response_bytes Serialized callback response size.",
+                f"# TYPE {p}_response_bytes summary"]
+      for callback, count in sorted(self._bytes_count.items()):
+        lines.append(f'{p}_response_bytes_count{{callback="{callback}"}} {count}')
+        lines.append(f'{p}_response_bytes_sum{{callback="{callback}"}} {self._bytes_sum[callback]}')
+    for name, (help_text, fn) in sorted(self._gauges.items()):
+      lines += [f"# HELP {p}_{name} {help_text}", f"# TYPE {p}_{name} gauge"]
+      value = fn()
+      if isinstance(value, dict):
+        for labels, v in value.items():
+          label_str = ",".join(f'{k}="{val}"' for k, val in labels)
+          lines.append(f"{p}_{name}{{{label_str}}} {v}")
+      else:
+        lines.append(f"{p}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(log_path=os.environ.get("METRICS_LOG"))
+# read at scrape time, so a forked worker reports its own pid
+metrics.gauge("worker_info", "Process that answered this scrape; metrics are per worker.",
+              lambda: {(("worker", os.getpid()),): 1})
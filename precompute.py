@@ -0,0 +1,40 @@
+"""Precompute embeddings for the shipped score table
+
+Embeds data/area2category_score_campus.csv for every campus filter and seed
+and writes them to an .npz artifact tagged with the CSV's checksum. The app
+loads it at startup, so the default view and the dropdown variants never run
+MDS on a cold start. Run at build time:
+
+  python precompute.py --seeds 2971 42
+"""
+import argparse
+from pathlib import Path
+
+from data_processor import DataProcessor
+from embedding_cache import EmbeddingCache, file_checksum
+
+DEFAULT_CSV = Path("./data/area2category_score_campus.csv")
+DEFAULT_OUTPUT = Path("./data/embeddings.npz")
+
+
+def precompute(csv_path=DEFAULT_CSV, output=DEFAULT_OUTPUT, seeds=(2971,), engine=None):
+  cache = EmbeddingCache(maxsize=1 << 16)
+  data_processor = None
+  for seed in seeds:
+    data_processor = DataProcessor(csv_path, mds_seed=seed, embedding_cache=cache, engine=engine)
+    campuses = sorted(set(data_processor.areas["campus"]) - {"IUB/IUI"})
+    for campus in ["IUB/IUI"] + campuses:
+      data_processor.update_from_dropdown(campus)
+  cache.save(output, file_checksum(csv_path))
+  print(f"wrote {len(cache)} embeddings ({data_processor.engine.name}) to {output}")
+  return len(cache)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--csv", type=Path, default=DEFAULT_CSV)
+  parser.add_argument("--output", type=Path, default=DEFAULT_OUTPUT)
+  parser.add_argument("--seeds", type=int, nargs="+", default=[2971])
+  parser.add_argument("--engine", default=None, help="embedding engine, defaults to $EMBEDDING_ENGINE or smacof")
+  args = parser.parse_args()
+  precompute(args.csv, args.output, args.seeds, args.engine)
@@ -0,0 +1,226 @@
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+  import fcntl
+except ImportError:  # windows: no cross-process locking
+  fcntl = None
+
+
+class SessionStore:
+  """Server-side per-session state with TTL eviction and a memory cap
+  
+  Each session owns the object returned by `factory()` (a DataProcessor in the
+  app). Use `session(session_id)` to get it under a per-session lock, or
+  `read(session_id)` for callbacks that do not change it. With a `directory`,
+  state is pickled to disk after every `session()` use so any worker process
+  or thread can serve any session; otherwise it lives in this process only.
+  Each process also keeps the last `cache_size` states it saved and reuses
+  them while their file is unchanged, so unpicklable caches (distance
+  matrices, exports) survive as long as a session stays on one worker.
+  """
+
+  def __init__(self, factory, ttl=3600, max_sessions=256, max_bytes=None, directory=None, cache_size=16):
+    self.factory = factory
+    self.ttl = ttl
+    self.max_sessions = max_sessions
+    self.max_bytes = max_bytes
+    self.directory = Path(directory) if directory else None
+    if self.directory is not None:
+      self.directory.mkdir(parents=True, exist_ok=True)
+    self._entries = OrderedDict()  # session_id -> (state, last_access, nbytes)
+    self.cache_size = cache_size
+    self._cache = OrderedDict()  # session file name -> (file id, state) saved by this process
+    self._locks = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    if self.directory is not None:
+      return sum(1 for _ in self.directory.glob("*.pkl"))
+    return len(self._entries)
+
+  def _session_lock(self, session_id):
+    with self._lock:
+      return self._locks.setdefault(session_id, threading.Lock())
+
+  def _path(self, session_id):
+    # session ids come from the browser, keep them to safe file names
+    safe_id = "".join(c for c in str(session_id) if c.isalnum() or c in "-_")
+    return self.directory.joinpath(f"{safe_id}.pkl")
+
+  @staticmethod
+  def _nbytes(state):
+    nbytes = getattr(state, "nbytes", None)
+    return nbytes() if callable(nbytes) else 0
+
+  @contextmanager
+  def session(self, session_id, save=True):
+    """Yield the state for `session_id`, creating it if missing or expired
+    
+    With `save=False` the state is not written back to the session directory.
+    """
+    self.evict()
+    with self._session_lock(session_id):
+      if self.directory is None:
+        state = self._get_memory(session_id)
+        yield state
+        self._update_nbytes(session_id, state)  # the callback may have grown or replaced the data
+      elif not save and not self._path(session_id).exists():
+        yield self.factory()  # nothing saved to read, and no lock file to leave behind
+      else:
+        with self._file_lock(session_id):
+          state = self._load(session_id)
+          try:
+            yield state
+          except BaseException:
+            self._forget(self._path(session_id))  # state may be half-updated, reload it next time
+            raise
+          if save:
+            self._dump(session_id, state)
+    self.evict()
+
+  def read(self, session_id):
+    """`session()` for read-only use: the state is not pickled again afterwards"""
+    return self.session(session_id, save=False)
+
+  def _get_memory(self, session_id):
+    with self._lock:
+      entry = self._entries.get(session_id)
+    state = entry[0] if entry is not None else self.factory()
+    with self._lock:
+      self._entries[session_id] = (state, time.monotonic(), self._nbytes(state))
+      self._entries.move_to_end(session_id)
+    return state
+
+  def _update_nbytes(self, session_id, state):
+    nbytes = self._nbytes(state)
+    with self._lock:
+      entry = self._entries.get(session_id)
+      if entry is not None and entry[0] is state:
+        self._entries[session_id] = (state, entry[1], nbytes)
+
+  @contextmanager
+  def _file_lock(self, session_id):
+    # lock files are never deleted: a process waiting on a deleted file's lock and one
+    # locking its re-created successor would both hold the session
+    if fcntl is None:
+      yield
+      return
+    with open(self._path(session_id).with_suffix(".lock"), "w") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  @staticmethod
+  def _file_id(path):
+    # os.replace gives every saved version a new inode
+    try:
+      stat = path.stat()
+    except FileNotFoundError:
+      return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+  def _forget(self, path):
+    with self._lock:
+      self._cache.pop(path.name, None)
+
+  def _load(self, session_id):
+    path = self._path(session_id)
+    file_id = self._file_id(path)
+    with self._lock:
+      cached = self._cache.get(path.name)
+    if cached is not None and file_id is not None and cached[0] == file_id:
+      return cached[1]  # no other process saved this session since
+    try:
+      with open(path, "rb") as f:
+        return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+      return self.factory()
+
+  def _dump(self, session_id, state):
+    path = self._path(session_id)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+      pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    if self.cache_size:
+      with self._lock:
+        self._cache[path.name] = (self._file_id(path), state)
+        self._cache.move_to_end(path.name)
+        while len(self._cache) > self.cache_size:
+          self._cache.popitem(last=False)
+
+  def discard(self, session_id):
+    with self._lock:
+      self._entries.pop(session_id, None)
+      self._locks.pop(session_id, None)
+    if self.directory is not None:
+      self._forget(self._path(session_id))
+      self._path(session_id).unlink(missing_ok=True)
+
+  def evict(self):
+    """Drop sessions idle longer than ttl, then least recently used ones over the caps"""
+    if self.directory is not None:
+      self._evict_directory()
+      return
+    now = time.monotonic()
+    with self._lock:
+      for session_id in [sid for sid, (_, last, _) in self._entries.items() if now - last > self.ttl]:
+        del self._entries[session_id]
+        self._locks.pop(session_id, None)
+      total = sum(nbytes for _, _, nbytes in self._entries.values())
+      while self._entries and (len(self._entries) > self.max_sessions
+                               or (self.max_bytes is not None and total > self.max_bytes)):
+        session_id, (_, _, nbytes) = self._entries.popitem(last=False)
+        self._locks.pop(session_id, None)
+        total -= nbytes
+
+  def _evict_directory(self):
+    now = time.time()
+    files = []
+    for path in self.directory.glob("*.pkl"):
+      try:
+        stat = path.stat()
+      except FileNotFoundError:
+        continue
+      if now - stat.st_mtime > self.ttl:
+        self._forget(path)
+        path.unlink(missing_ok=True)
+      else:
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    while files and (len(files) > self.max_sessions
+                     or (self.max_bytes is not None and total > self.max_bytes)):
+      _, size, path = files.pop(0)
+      self._forget(path)
+      path.unlink(missing_ok=True)
+      total -= size
+    # drop the thread locks of sessions without a file (evicted, or never saved) unless in use;
+    # the file lock still serializes a request that raced with this
+    saved = {path.name for _, _, path in files}
+    with self._lock:
+      for session_id in [sid for sid, lock in self._locks.items()
+                         if self._path(sid).name not in saved and not lock.locked()]:
+        del self._locks[session_id]
+
+  def stats(self):
+    """Session count and bytes held: state memory, or the size of the session files with a directory"""
+    if self.directory is not None:
+      nbytes = 0
+      for path in self.directory.glob("*.pkl"):
+        try:
+          nbytes += path.stat().st_size
+        except FileNotFoundError:
+          continue
+      return {"sessions": len(self), "nbytes": nbytes}
+    with self._lock:
+      nbytes = sum(nbytes for _, _, nbytes in self._entries.values())
+    return {"sessions": len(self), "nbytes": nbytes}
@@ -0,0 +1,12 @@
+"""WSGI entry point for gunicorn: gunicorn -c gunicorn.conf.py "wsgi:create_app()"
+
+With preload_app (see gunicorn.conf.py) create_app runs once in the master:
+the csvs, the precomputed embeddings and the default layout are loaded there
+and shared with the forked workers copy-on-write.
+"""
+
+
+def create_app():
+  """Flask server of the Dash app, loading all data on first call"""
+  import dash_app
+  return dash_app.app.server